@@ -0,0 +1,449 @@
+"""Benchmarks for torrent-fs against an offline swarm of local seeders
+
+Synthetic torrents are generated in a work directory (and reused by later
+runs), seeded from 127.0.0.1 with DHT, LSD, UPnP and NAT-PMP disabled, and
+torrentfs.py is mounted against them in a subprocess with the same settings
+and no trackers, so the benchmark never talks to the internet. Results are written
+as JSON, so runs from different commits can be compared.
+
+    python benchmark.py --work /tmp/torrentfs-bench --output results.json
+"""
+import os
+import sys
+import json
+import time
+import errno
+import random
+import shutil
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import libtorrent as lt
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 128 * 1024  # read size of the read benchmarks, what the kernel asks FUSE for by default
+GiB = 1024 * 1024 * 1024
+MiB = 1024 * 1024
+
+# libtorrent settings of the seeders and of the mounted session, so neither leaves the loopback
+# interface; the mount connects to every seeder from the same address
+OFFLINE_SETTINGS = {
+    'listen_interfaces': '127.0.0.1:0',
+    'enable_dht': False,
+    'enable_lsd': False,
+    'enable_upnp': False,
+    'enable_natpmp': False,
+    'allow_multiple_connections_per_ip': True,
+}
+
+
+def make_tiny_files(directory, count, size, seed=0):
+    """Write count files of size bytes with reproducible contents, spread over subdirectories"""
+    rand = random.Random(seed)
+    for i in range(count):
+        path = os.path.join(directory, f"dir{i // 1000:03d}", f"file{i:06d}.bin")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(rand.randbytes(size))
+
+
+def make_sparse_file(path, size):
+    """Create a file of size bytes that takes no space on disk"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        file.truncate(size)
+
+
+def make_torrent(content, torrent_path, piece_size):
+    """Hash content (a file or directory) into a .torrent file"""
+    storage = lt.file_storage()
+    lt.add_files(storage, content)
+    creator = lt.create_torrent(storage, piece_size)
+    lt.set_piece_hashes(creator, os.path.dirname(content))
+
+    with open(torrent_path, 'wb') as file:
+        file.write(lt.bencode(creator.generate()))
+
+
+def prepare(work, tiny_count, tiny_size, large_size, piece_sizes):
+    """Generate the content and torrents of every scenario, unless a previous run did
+
+    Returns a list of (scenario, .torrent path, content directory).
+    """
+    source = os.path.join(work, 'source')  # the .torrent files torrentfs expands
+    data = os.path.join(work, 'data')  # the payload the seeders serve
+    os.makedirs(source, exist_ok=True)
+    scenarios = []
+
+    name = f"tiny-{tiny_count}x{tiny_size}"
+    content = os.path.join(data, name)
+    torrent = os.path.join(source, name + '.torrent')
+    if not os.path.exists(torrent):
+        logger.info("Generating %s", name)
+        make_tiny_files(content, tiny_count, tiny_size)
+        make_torrent(content, torrent, 16 * 1024)
+    scenarios.append((name, torrent, data))
+
+    for piece_size in piece_sizes:
+        name = f"sparse-{large_size // MiB}M-piece{piece_size // 1024}K"
+        content = os.path.join(data, name, 'payload.bin')
+        torrent = os.path.join(source, name + '.torrent')
+        if not os.path.exists(torrent):
+            logger.info("Generating %s", name)
+            make_sparse_file(content, large_size)
+            make_torrent(os.path.join(data, name), torrent, piece_size)
+        scenarios.append((name, torrent, data))
+
+    return source, scenarios
+
+
+class Seeder:
+    """A libtorrent session seeding torrents on the loopback interface only"""
+    def __init__(self):
+        self.session = lt.session({**OFFLINE_SETTINGS, 'alert_mask': 0})
+
+    @property
+    def address(self):
+        return f"127.0.0.1:{self.session.listen_port()}"
+
+    def seed(self, torrent_path, save_path):
+        params = lt.add_torrent_params()
+        params.ti = lt.torrent_info(torrent_path)
+        params.save_path = save_path
+        params.flags |= lt.torrent_flags.seed_mode  # the data is known to be complete, skip checking it
+        self.session.add_torrent(params)
+
+
+@contextmanager
+def mounted(source, mountpoint, peers, args=()):
+    """Run torrentfs.py on mountpoint until the block exits, without trackers and off the internet"""
+    os.makedirs(mountpoint, exist_ok=True)
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'torrentfs.py'),
+               mountpoint, source, '--no-trackers', *args]
+    for name, value in OFFLINE_SETTINGS.items():
+        command += ['--setting', f"{name}={str(value).lower() if isinstance(value, bool) else value}"]
+    for peer in peers:
+        command += ['--peer', peer]
+
+    process = subprocess.Popen(command)
+    try:
+        deadline = time.monotonic() + 30
+        while not os.path.ismount(mountpoint):
+            if process.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError(f"Failed to mount {mountpoint}")
+            time.sleep(0.1)
+        yield mountpoint
+    finally:
+        subprocess.run(['fusermount', '-u', mountpoint], check=False)
+        process.wait(timeout=30)
+
+
+def percentiles(samples):
+    """Summarize latencies in seconds"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered),
+            'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99), 'max': ordered[-1]}
+
+
+def bench_listing(root, repeat):
+    """Walk root and stat every entry, repeat times"""
+    rounds = []
+    for _ in range(repeat):
+        entries = 0
+        start = time.perf_counter()
+        for directory, dirs, files in os.walk(root):
+            for name in dirs + files:
+                os.stat(os.path.join(directory, name))
+                entries += 1
+        elapsed = time.perf_counter() - start
+        rounds.append({'entries': entries, 'seconds': elapsed, 'entries_per_second': entries / elapsed})
+    return rounds
+
+
+def bench_first_byte(path):
+    start = time.perf_counter()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.pread(fd, BLOCK, 0)
+    finally:
+        os.close(fd)
+    return time.perf_counter() - start
+
+
+def bench_sequential(path, limit):
+    """Read up to limit bytes of path from the start in BLOCK sized reads"""
+    latencies = []
+    total = 0
+    fd = os.open(path, os.O_RDONLY)
+    start = time.perf_counter()
+    try:
+        while total < limit:
+            t = time.perf_counter()
+            data = os.pread(fd, BLOCK, total)
+            latencies.append(time.perf_counter() - t)
+            if not data:
+                break
+            total += len(data)
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    return {'bytes': total, 'seconds': elapsed, 'bytes_per_second': total / elapsed,
+            'latency': percentiles(latencies)}
+
+
+def bench_random(path, reads, seed=0):
+    """Read BLOCK bytes at reads random offsets of path"""
+    rand = random.Random(seed)
+    size = os.path.getsize(path)
+    latencies = []
+    fd = os.open(path, os.O_RDONLY)
+    start = time.perf_counter()
+    try:
+        for _ in range(reads):
+            offset = rand.randrange(0, max(1, size - BLOCK)) // 4096 * 4096
+            t = time.perf_counter()
+            os.pread(fd, BLOCK, offset)
+            latencies.append(time.perf_counter() - t)
+    finally:
+        os.close(fd)
+    elapsed = time.perf_counter() - start
+    return {'reads': reads, 'seconds': elapsed, 'bytes_per_second': reads * BLOCK / elapsed,
+            'latency': percentiles(latencies)}
+
+
+def make_stalled(work, size):
+    """Generate a torrent that no seeder serves, so reads of it block
+
+    Returns the .torrent path, kept outside the source tree of the other scenarios.
+    """
+    stalled = os.path.join(work, 'stalled')
+    torrent = os.path.join(stalled, 'stalled.torrent')
+    if not os.path.exists(torrent):
+        make_tiny_files(os.path.join(stalled, 'data', 'stalled'), 1, size, seed=1)
+        make_torrent(os.path.join(stalled, 'data', 'stalled'), torrent, 256 * 1024)
+    return torrent
+
+
+def bench_stress(root, data, stalled, readers, listers, limit, seed=0):
+    """Read a different file from each of readers threads while listers threads walk root
+
+    Another thread reads stalled, a file no seeder has, for as long as the
+    mount's read timeout, and the listers keep walking and stating root
+    until it gave up. Every block read is compared with the seeders' copy
+    under data, and listing rounds have to complete while the stalled read
+    is blocked, or metadata operations queue behind downloads.
+    """
+    files = []
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]  # the mount's own stats
+        files += [os.path.join(directory, name) for name in names]
+    files = [path for path in files if path != stalled]
+    files = sorted(files, key=os.path.getsize, reverse=True)[:readers]
+
+    lock = threading.Lock()
+    errors, mismatches, latencies, rounds = [], [], [], []
+    blocked = {}
+    done = threading.Event()
+
+    def read(path, index):
+        rand = random.Random(seed + index)
+        size = os.path.getsize(path)
+        expected = os.open(os.path.join(data, os.path.relpath(path, root)), os.O_RDONLY)
+        fd = os.open(path, os.O_RDONLY)
+        total = 0
+        try:
+            while total < min(size, limit):
+                offset = rand.randrange(0, max(1, size - BLOCK)) // 4096 * 4096
+                t = time.perf_counter()
+                chunk = os.pread(fd, BLOCK, offset)
+                elapsed = time.perf_counter() - t
+                with lock:
+                    latencies.append(elapsed)
+                    if chunk != os.pread(expected, BLOCK, offset):
+                        mismatches.append(f"{path} @ {offset}")
+                total += max(len(chunk), 1)
+        except OSError as e:
+            with lock:
+                errors.append(f"{path}: {e}")
+        finally:
+            os.close(fd)
+            os.close(expected)
+        return total
+
+    def read_stalled():
+        blocked['start'] = time.perf_counter()
+        try:
+            fd = os.open(stalled, os.O_RDONLY)
+            try:
+                os.pread(fd, BLOCK, 0)
+                blocked['error'] = None
+            finally:
+                os.close(fd)
+        except OSError as e:
+            blocked['error'] = errno.errorcode.get(e.errno, str(e.errno))
+        blocked['end'] = time.perf_counter()
+
+    def walk():
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                for directory, dirs, names in os.walk(root):
+                    for name in dirs + names:
+                        os.stat(os.path.join(directory, name))
+            except OSError as e:
+                with lock:
+                    errors.append(f"listing: {e}")
+            with lock:
+                rounds.append((start, time.perf_counter()))
+
+    staller = threading.Thread(target=read_stalled)
+    staller.start()
+    walkers = [threading.Thread(target=walk) for _ in range(listers)]
+    for walker in walkers:
+        walker.start()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max(1, len(files))) as executor:
+        total = sum(executor.map(read, files, range(len(files))))
+    elapsed = time.perf_counter() - start
+
+    staller.join()
+    done.set()
+    for walker in walkers:
+        walker.join()
+
+    while_blocked = [end - begin for begin, end in rounds if begin >= blocked['start'] and end <= blocked['end']]
+    return {
+        'files': len(files),
+        'bytes': total,
+        'seconds': elapsed,
+        'bytes_per_second': total / elapsed,
+        'latency': percentiles(latencies),
+        'mismatches': mismatches,
+        'errors': errors,
+        'stalled_read': {'seconds': blocked['end'] - blocked['start'], 'error': blocked['error']},
+        'listing_while_blocked': percentiles(while_blocked),
+        'ok': not mismatches and not errors and bool(while_blocked) and blocked['error'] == 'ETIMEDOUT',
+    }
+
+
+def largest_file(root):
+    best = None
+    for directory, _, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            size = os.path.getsize(path)
+            if best is None or size > best[1]:
+                best = (path, size)
+    return best[0]
+
+
+def run(args):
+    source, scenarios = prepare(args.work, args.tiny_count, args.tiny_size, args.large_size,
+                                [size * 1024 for size in args.piece_sizes])
+
+    seeders = [Seeder() for _ in range(args.seeders)]
+    for seeder in seeders:
+        for _, torrent, data in scenarios:
+            seeder.seed(torrent, data)
+
+    results = {
+        'commit': subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip(),
+        'time': time.time(),
+        'python': platform.python_version(),
+        'libtorrent': lt.__version__,
+        'parameters': {key: value for key, value in vars(args).items() if key != 'output'},
+        'scenarios': {},
+    }
+
+    mountpoint = os.path.join(args.work, 'mnt')
+    for name, _, _ in scenarios:
+        cache = os.path.join(args.work, 'cache')
+        shutil.rmtree(cache, ignore_errors=True)  # every scenario starts cold
+
+        with mounted(source, mountpoint, [s.address for s in seeders],
+                     ['--cache-dir', cache, *args.torrentfs_args]):
+            root = os.path.join(mountpoint, name)
+            logger.info("Benchmarking %s", name)
+
+            listing = bench_listing(root, args.repeat)
+            path = largest_file(root)
+            results['scenarios'][name] = {
+                'listing': listing,
+                'first_byte_seconds': bench_first_byte(path),
+                'sequential': bench_sequential(path, args.sequential_bytes),
+                'random': bench_random(path, args.random_reads),
+            }
+
+    if args.stress_readers:
+        cache = os.path.join(args.work, 'cache')
+        shutil.rmtree(cache, ignore_errors=True)
+        stalled = make_stalled(args.work, 4 * MiB)
+        shutil.copy(stalled, source)
+        try:
+            with mounted(source, mountpoint, [s.address for s in seeders],
+                         ['--cache-dir', cache, '--read-timeout', str(args.stress_timeout),
+                          *args.torrentfs_args]):
+                logger.info("Stress testing with %d readers and %d listers", args.stress_readers, args.stress_listers)
+                results['stress'] = bench_stress(mountpoint, os.path.join(args.work, 'data'),
+                                                 os.path.join(mountpoint, 'stalled', 'dir000', 'file000000.bin'),
+                                                 args.stress_readers, args.stress_listers, args.stress_bytes)
+        finally:
+            os.remove(os.path.join(source, os.path.basename(stalled)))
+
+        if not results['stress']['ok']:
+            logger.error("Stress test failed: %s", {key: results['stress'][key]
+                                                    for key in ('mismatches', 'errors', 'stalled_read')})
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("--work", help="Directory for generated torrents, payloads and the mountpoint",
+                        default=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'torrentfs-bench'))
+    parser.add_argument("-o", "--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--seeders", help="Number of local seeders", type=int, default=2)
+    parser.add_argument("--tiny-count", help="Files in the many-tiny-files torrent", type=int, default=10000)
+    parser.add_argument("--tiny-size", help="Bytes per tiny file", type=int, default=1024)
+    parser.add_argument("--large-size", help="Bytes of the sparse single-file torrents", type=int, default=20 * GiB)
+    parser.add_argument("--piece-sizes", help="Piece sizes in KiB of the sparse torrents", type=int, nargs='+',
+                        default=[256, 1024, 4096])
+    parser.add_argument("--repeat", help="Rounds of the listing benchmark", type=int, default=3)
+    parser.add_argument("--sequential-bytes", help="Bytes read by the sequential benchmark", type=int,
+                        default=1 * GiB)
+    parser.add_argument("--random-reads", help="Reads done by the random read benchmark", type=int, default=200)
+    parser.add_argument("--stress-readers", help="Threads reading different files in the stress test (0 skips it)",
+                        type=int, default=8)
+    parser.add_argument("--stress-listers", help="Threads walking the mount in the stress test", type=int, default=2)
+    parser.add_argument("--stress-bytes", help="Bytes each stress test reader reads", type=int, default=64 * MiB)
+    parser.add_argument("--stress-timeout", help="Read timeout of the stress test mount, how long listers run "
+                        "against a blocked read", type=float, default=30)
+    parser.add_argument("torrentfs_args", help="Extra arguments for torrentfs.py, after --", nargs='*')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)-8s %(message)s')
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if not results.get('stress', {}).get('ok', True):
+        sys.exit(1)
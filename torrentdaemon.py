@@ -0,0 +1,357 @@
+"""Shared torrent session for several torrentfs.py mounts
+
+One daemon owns the libtorrent session, the piece and download caches and
+the metadata index. Mounts started with `--daemon <socket>` send it their
+opens and reads over a Unix domain socket, so any number of mounts of the
+same source tree download every piece once and share one set of peers.
+
+Requests and replies are fixed size headers followed by a payload. Read
+replies only say how many bytes are ready, the file descriptor of the
+payload file is passed to the mount once with SCM_RIGHTS and the mount
+reads from it directly. Only data held in the daemon's piece cache is sent
+over the socket. The source tree has to be visible under the same path to
+the daemon and to every mount.
+
+    python torrentdaemon.py /run/torrentfs.sock --cache-dir /var/cache/torrentfs
+"""
+import os
+import json
+import errno
+import queue
+import socket
+import struct
+import logging
+import argparse
+import itertools
+import threading
+import socketserver
+from collections import namedtuple
+
+from torrentindex import MetadataCache
+from torrentstream import TorrentSession, TorrentError, ReadTimeout, add_session_arguments, session_options
+from torrentmetrics import Metrics, MetricsServer
+
+logger = logging.getLogger(__name__)
+
+# op, flags, handle, offset, length, payload length
+REQUEST = struct.Struct('!BBQQII')
+# errno (0 on success), value, payload length
+REPLY = struct.Struct('!iQI')
+
+OP_OPEN = 1  # payload: .torrent path, offset: file index, flags: NONBLOCK; value: handle
+OP_READ = 2  # value: bytes ready at offset, payload: the data when it is not read from the fd
+OP_CLOSE = 3
+OP_HAVE_PIECES = 4  # payload: info hash; payload: a byte per piece, 1 if downloaded
+OP_RATE = 5  # payload: info hash; value: bytes per second
+OP_RELEASE = 6  # payload: path of a gone .torrent file or directory
+OP_STATUS = 7  # payload: JSON of the cached bytes and every torrent's status
+
+FLAG_NONBLOCK = 1
+FLAG_WANT_FD = 2  # the mount has no descriptor of the payload file yet
+
+TorrentStatus = namedtuple('TorrentStatus', ['info_hash', 'status'])
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:  # an errno, so a mount answers EIO rather than failing in fusepy
+            raise ConnectionResetError(errno.ECONNRESET, "Connection closed")
+        data += chunk
+    return bytes(data)
+
+
+class SessionServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves a `TorrentSession` to `SessionClient`s on a Unix socket
+
+    Every connection is served by its own thread. Files stay open until
+    their mount closes them or the connection that opened them goes away.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, session: TorrentSession, metadata: MetadataCache):
+        self.session = session
+        self.metadata = metadata
+        self.readers = {}  # handle -> TorrentFileReader
+        self._handles = itertools.count(1)
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):  # left behind by a daemon that did not shut down
+            os.remove(path)
+        super().__init__(path, SessionHandler)
+
+    def open(self, torrent_path, index, nonblocking):
+        reader = self.session.open_file(torrent_path, index, meta=self.metadata.get(torrent_path),
+                                        nonblocking=nonblocking)
+        with self._lock:
+            handle = next(self._handles)
+            self.readers[handle] = reader
+        return handle
+
+    def close(self, handle):
+        with self._lock:
+            reader = self.readers.pop(handle, None)
+        if reader:
+            reader.close()
+
+    def status(self):
+        return json.dumps({
+            'cached_bytes': self.session.cached_bytes,
+            'torrents': {torrent.info_hash: torrent.status for torrent in self.session},
+        }).encode()
+
+
+class SessionHandler(socketserver.BaseRequestHandler):
+    """Answers the requests of one connection until the mount closes it"""
+    def setup(self):
+        self.opened = set()  # handles opened through this connection
+
+    def handle(self):
+        while True:
+            try:
+                op, flags, handle, offset, length, size = REQUEST.unpack(recv_exactly(self.request, REQUEST.size))
+                payload = recv_exactly(self.request, size)
+            except ConnectionError:
+                return
+
+            fds = []
+            try:
+                value, data, fds = self.dispatch(op, flags, handle, offset, length, payload)
+                error = 0
+            except BlockingIOError:
+                value, data, error = 0, b'', errno.EAGAIN
+            except ReadTimeout as e:
+                value, data, error = 0, str(e).encode(), errno.ETIMEDOUT
+            except TorrentError as e:
+                value, data, error = 0, str(e).encode(), errno.EIO
+            except KeyError:
+                value, data, error = 0, b'', errno.EBADF
+            except OSError as e:
+                value, data, error = 0, str(e).encode(), e.errno or errno.EIO
+            except Exception as e:
+                logger.exception("Failed to serve request %d", op)
+                value, data, error = 0, str(e).encode(), errno.EIO
+
+            message = REPLY.pack(error, value, len(data)) + data
+            if fds:
+                socket.send_fds(self.request, [message], fds)
+            else:
+                self.request.sendall(message)
+
+    def dispatch(self, op, flags, handle, offset, length, payload):
+        """Serve one request, returns the reply's value, payload and file descriptors to pass"""
+        server = self.server
+        session = server.session
+
+        if op == OP_READ:
+            reader = server.readers[handle]
+            length, downloaded = reader.wait(length, offset)
+            torrent = reader.file.torrent
+            if length and reader.cached:
+                torrent.metrics.add('bytes_downloaded' if downloaded else 'bytes_cache', length)
+                return length, torrent.read_cached(reader.file.offset + offset, length), []
+            torrent.metrics.add('bytes_downloaded' if downloaded else 'bytes_disk', length)
+            return length, b'', [reader.fileno()] if length and flags & FLAG_WANT_FD else []
+
+        if op == OP_OPEN:
+            handle = server.open(os.fsdecode(payload), offset, bool(flags & FLAG_NONBLOCK))
+            self.opened.add(handle)
+            return handle, b'', []
+
+        if op == OP_CLOSE:
+            self.opened.discard(handle)
+            server.close(handle)
+            return 0, b'', []
+
+        if op == OP_HAVE_PIECES:
+            return 0, bytes(map(bool, session.have_pieces(payload.decode()))), []
+        if op == OP_RATE:
+            return session.download_rate(payload.decode()), b'', []
+        if op == OP_RELEASE:
+            session.release_torrents(os.fsdecode(payload))
+            return 0, b'', []
+        if op == OP_STATUS:
+            return 0, server.status(), []
+
+        raise OSError(errno.ENOSYS, f"Unknown request {op}")
+
+    def finish(self):
+        for handle in self.opened:  # the mount went away without closing them
+            self.server.close(handle)
+
+
+class SessionClient:
+    """Stands in for a `TorrentSession` in a mount, forwarding to a `SessionServer`
+
+    Connections are pooled, a thread takes one for each request, so
+    concurrent reads do not wait for each other.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._pool = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._pool.put(self._connect())  # fail right away if the daemon is not running
+
+    def __repr__(self):
+        return f"SessionClient({self.path}, {len(self._connections)} connections)"
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        with self._lock:
+            self._connections.append(sock)
+        return sock
+
+    def _discard(self, sock):
+        """Close sock and the idle connections, which are as dead if the daemon restarted"""
+        dead = [sock]
+        while True:
+            try:
+                dead.append(self._pool.get_nowait())
+            except queue.Empty:
+                break
+
+        with self._lock:
+            self._connections = [c for c in self._connections if c not in dead]
+        for c in dead:
+            c.close()
+
+    def request(self, op, handle=0, offset=0, length=0, payload=b'', flags=0):
+        """Send a request and return the reply's value, payload and passed file descriptors"""
+        try:
+            sock = self._pool.get_nowait()
+        except queue.Empty:
+            sock = self._connect()
+
+        try:
+            sock.sendall(REQUEST.pack(op, flags, handle, offset, length, len(payload)) + payload)
+            header, fds, _, _ = socket.recv_fds(sock, REPLY.size, 1)
+            if not header:
+                raise ConnectionResetError(errno.ECONNRESET, "Daemon closed the connection")
+            error, value, size = REPLY.unpack(header + recv_exactly(sock, REPLY.size - len(header)))
+            data = recv_exactly(sock, size)
+        except OSError:
+            self._discard(sock)  # the stream may be out of step, the next request connects again
+            raise
+        self._pool.put(sock)
+
+        if error == errno.EAGAIN:
+            raise BlockingIOError(error, os.strerror(error))
+        if error == errno.ETIMEDOUT:
+            raise ReadTimeout(data.decode())
+        if error == errno.EIO:
+            raise TorrentError(data.decode())
+        if error:
+            raise OSError(error, data.decode() or os.strerror(error))
+        return value, data, fds
+
+    def open_file(self, torrent_path, index, meta=None, nonblocking=False):
+        handle, _, _ = self.request(OP_OPEN, offset=index, payload=os.fsencode(torrent_path),
+                                    flags=FLAG_NONBLOCK if nonblocking else 0)
+        return RemoteReader(self, handle)
+
+    def have_pieces(self, info_hash):
+        _, data, _ = self.request(OP_HAVE_PIECES, payload=info_hash.encode())
+        return [bool(have) for have in data]
+
+    def download_rate(self, info_hash):
+        return self.request(OP_RATE, payload=info_hash.encode())[0]
+
+    def release_torrents(self, path):
+        self.request(OP_RELEASE, payload=os.fsencode(path))
+
+    def _status(self):
+        return json.loads(self.request(OP_STATUS)[1])
+
+    @property
+    def cached_bytes(self):
+        return self._status()['cached_bytes']
+
+    def __iter__(self):
+        return iter([TorrentStatus(info_hash, status) for info_hash, status in self._status()['torrents'].items()])
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for sock in connections:
+            sock.close()
+
+
+class RemoteReader:
+    """A file opened through a `SessionClient`, read from the payload file the daemon passed"""
+    def __init__(self, client: SessionClient, handle):
+        self.client = client
+        self.handle = handle
+        self.fd = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"RemoteReader({self.handle})"
+
+    def read(self, length, offset):
+        ready, data, fds = self.client.request(OP_READ, self.handle, offset, length,
+                                               flags=FLAG_WANT_FD if self.fd is None else 0)
+        with self._lock:
+            for fd in fds:
+                if self.fd is None:
+                    self.fd = fd
+                else:  # another thread asked for it at the same time
+                    os.close(fd)
+            fd = self.fd
+
+        if data or not ready:
+            return data
+        return os.pread(fd, ready, offset)
+
+    def close(self):
+        try:
+            self.client.request(OP_CLOSE, self.handle)
+        finally:
+            with self._lock:
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+
+
+def main(path, index_path=None, metrics_port=None, **session_args):
+    metrics = Metrics()
+    metadata = MetadataCache(index_path=index_path)
+    session = TorrentSession(metrics=metrics, **session_args)
+
+    metrics_server = None
+    if metrics_port:
+        metrics_server = MetricsServer(metrics, session, port=metrics_port)
+        metrics_server.start()
+
+    server = SessionServer(path, session, metadata)
+    logger.info(f"Serving {session} on {path}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        if metrics_server:
+            metrics_server.stop()
+        session.close()
+        metadata.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument("socket", help="Path of the Unix socket to serve mounts on")
+    parser.add_argument("-v", "--verbose", help="Set loglevel to debug", action="store_true")
+    parser.add_argument("--index", help="Path to an on-disk torrent metadata index",
+                        default=os.environ.get('INDEX'))
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics on this local port",
+                        type=int, default=int(os.environ.get('METRICS_PORT', 0)) or None)
+    add_session_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if os.environ.get('DEBUG') or args.verbose else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s')
+
+    main(args.socket, index_path=args.index, metrics_port=args.metrics_port, **session_options(args))
@@ -1,222 +1,388 @@
 import os
 import sys
+import time
+import stat
 import errno
+import hashlib
 import logging
+import tempfile
 import warnings
 import argparse
+import itertools
+import threading
 
-import libtorrent as lt
-from torrentstream import TorrentSession
+from torrentindex import MetadataCache, PathResolver, PreIndexer, SourceWatcher, TORRENT_EXT, CACHE_TTL, WATCH_TTL
+from torrentstream import TorrentSession, TorrentError, ReadTimeout, add_session_arguments, session_options
+from torrentdaemon import SessionClient
+from torrentmetrics import Metrics, MetricsServer, STATS_TTL
 from fuse import FUSE, FuseOSError, Operations
 
 # we're getting deprectation warnings from libtorrent.torrent_info()
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+MAX_READ = 1024 * 1024  # largest read request to ask the kernel for, it may cap it lower
 
-class TorrentFS(Operations):
-    def __init__(self, root):
-        self.root = root
-        self.torrent_session = TorrentSession()
-        logger.debug(f"Started torrent session: {self.torrent_session}")
-
-    # Helpers
-    # =======
-
-    def _full_path(self, partial):
-        if partial.startswith("/"):
-            partial = partial[1:]
-        path = os.path.join(self.root, partial)
-        return path
-
-    def _open_torrent(self, torrent_path):
-        with self.torrent_session.add_torrent(torrent_path=torrent_path, remove_after=True) as torrent:
-            torrent.sequential(True)
-
-            while torrent.wait_for('started'):
-                logger.debug(f"{torrent.info.name()}: {torrent.info.state()}")
-                time.sleep(1)
-
-            return torrent
-
-    def _torrent_path(self, full_path):
-        paths = full_path.split('/')
-        tmp_path = ''
-
-        for p in paths:
-            tmp_path = os.path.join(tmp_path, p)
-            torrent_file = f"{tmp_path}.torrent"
-            
-            if os.path.isfile(torrent_file):
-                return torrent_file
+STATS_DIR = '/.torrentfs'
+STATS_FILE = STATS_DIR + '/stats.json'
 
-        return None
+XATTR_PREFIX = 'user.torrentfs.'
+XATTRS = tuple(XATTR_PREFIX + name for name in ('progress', 'piece_map', 'piece_length', 'piece_offset', 'rate'))
 
-    def _get_paths(self, full_path):
-        sub_path = None
-        fake_base = None
-        torrent_path = self._torrent_path(full_path)
+DIR_MASK = 0o044555
+ATTRS = ('st_atime', 'st_ctime', 'st_gid', 'st_ino', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid')
 
-        if torrent_path:
-            fake_base = torrent_path.replace('.torrent', '')
-            sub_path = full_path.replace(fake_base, '')
-
-        return torrent_path, fake_base, sub_path
-
-    def _find_fpath(self, path, torrent_name):
-        dirpath, filename = os.path.split(path)
 
-        if dirpath.startswith(torrent_name):
-            dirpath = dirpath.replace(torrent_name, '')
+def virtual_ino(torrent_ino, sub_path):
+    """Inode number of sub_path inside the torrent whose .torrent file has torrent_ino
 
-        if not dirpath.startswith('/'):
-            dirpath = f"/{dirpath}"
+    Derived from both, so it stays the same across remounts, with the top bit
+    set so it does not collide with the inodes of passthrough files.
+    """
+    digest = hashlib.blake2b(f"{torrent_ino}:{sub_path}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') | 1 << 63
 
-        return dirpath, filename
 
+class TorrentFS(Operations):
+    def __init__(self, root, index_path=None, cache_ttl=CACHE_TTL, metrics_port=None, preindex_workers=0,
+                 watch=False, daemon=None, session_args=None):
+        self.root = os.path.abspath(root)
+
+        self.watcher = None
+        polled_ttl = cache_ttl
+        if watch:  # changes are pushed, the ttl only guards against missed ones
+            cache_ttl = max(cache_ttl, WATCH_TTL)
+
+        self.metadata = MetadataCache(index_path=index_path, ttl=cache_ttl)
+        self.resolver = PathResolver(self.root, ttl=cache_ttl, metadata=self.metadata)
+        self.handles = {}  # fh -> os fd for plain files, TorrentFileReader for torrent files, bytes for stats
+        self._fh = itertools.count(1)
+        self.metrics = Metrics()
+        self._stats = (0, b'')  # (time rendered, stats.json contents)
+        self._session = None  # started, or connected to the daemon, on the first open of a torrent file
+        self._session_args = dict(session_args or {}, metrics=self.metrics)  # `TorrentSession` arguments
+        self.daemon = daemon  # socket of a torrentdaemon.py owning the session instead
+        self._session_lock = threading.Lock()
+
+        # downloads land here, statfs reports its free space, the daemon's is not known
+        cache_dir = self._session_args.get('cache_dir')
+        self.download_dir = cache_dir if cache_dir and not daemon else tempfile.gettempdir()
+        os.makedirs(self.download_dir, exist_ok=True)
+
+        self.metrics.gauge('tree_bytes', lambda: self.metadata.total_bytes)
+        self.metrics.gauge('tree_files', lambda: self.metadata.total_files)
+        self.metrics.gauge('cached_bytes', lambda: self._session.cached_bytes if self._session else 0)
+
+        self.metrics_server = None
+        if metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, port=metrics_port)
+            self.metrics_server.start()
+
+        if watch:
+            try:
+                self.watcher = SourceWatcher(self.root, self.metadata, self.resolver,
+                                             on_removed=self._torrent_removed)
+                self.watcher.start()
+            except OSError as e:
+                logger.warning(f"Not watching {self.root}, relying on --cache-ttl: {e}")
+                self.metadata.ttl = self.resolver.ttl = polled_ttl
+
+        self.preindexer = None
+        if preindex_workers:
+            self.preindexer = PreIndexer(self.root, self.metadata, self.resolver, workers=preindex_workers)
+            self.preindexer.start()
+
+    @property
+    def torrent_session(self):
+        """The `TorrentSession`, or a `SessionClient` of the daemon, started when it is first needed"""
+        with self._session_lock:
+            if self._session is None:
+                if self.daemon:
+                    self._session = SessionClient(self.daemon)
+                else:
+                    self._session = TorrentSession(**self._session_args)
+                logger.debug("Started torrent session: %s", self._session)
+                if self.metrics_server:
+                    self.metrics_server.session = self._session
+            return self._session
+
+    def __call__(self, op, *args):
+        start = time.perf_counter()
+        try:
+            return super().__call__(op, *args)
+        except Exception as e:
+            # EAGAIN is how non-blocking reads of missing pieces are answered, not a failure
+            if not isinstance(e, BlockingIOError) and getattr(e, 'errno', None) != errno.EAGAIN:
+                self.metrics.add(f'{op}_errors')
+            raise
+        finally:
+            self.metrics.observe(op, time.perf_counter() - start)
 
-    def _file_in_torrent(self, sub_path, torrent_path):
-        info = lt.torrent_info(torrent_path)
-        paths = []
+    # Helpers
+    # =======
 
-        for f in info.files():
-            dirpath, filename = self._find_fpath(f.path, info.name())
-            paths.append(os.path.join(dirpath, filename))
+    def _torrent_removed(self, path):
+        """Detach the torrents of a deleted .torrent file, or of a moved away directory, from the session"""
+        if self._session:
+            self._session.release_torrents(path)
+
+    def _stats_json(self):
+        """Return the contents of the stats file, rendered at most once per STATS_TTL
+
+        getattr and a following open see the same contents, so the reported
+        size matches what is read.
+        """
+        rendered, data = self._stats
+        if time.monotonic() - rendered >= STATS_TTL:
+            data = self.metrics.to_json(self._session)
+            self._stats = (time.monotonic(), data)
+        return data
+
+    def _stats_attr(self, path):
+        st = os.lstat(self.root)
+        if path == STATS_DIR:
+            mode, size = 0o040555, 0
+        else:
+            mode, size = 0o100444, len(self._stats_json())
+        return {'st_atime': st.st_atime, 'st_ctime': st.st_ctime, 'st_gid': st.st_gid,
+                'st_ino': virtual_ino(st.st_ino, path), 'st_mode': mode, 'st_mtime': time.time(),
+                'st_nlink': 1, 'st_size': size, 'st_uid': st.st_uid}
+
+    @staticmethod
+    def _node_attr(base, meta, sub_path, node):
+        """Attributes of the file or directory node at sub_path inside a torrent
+
+        base holds the attributes of the .torrent file, which every entry
+        inside it inherits.
+        """
+        attrs = dict(base, st_ino=virtual_ino(base['st_ino'], sub_path))
+        if isinstance(node, dict):
+            attrs['st_mode'] = DIR_MASK
+        else:
+            attrs['st_size'] = meta.sizes[node]
+        return attrs
+
+    def _file_xattr(self, meta, index, name):
+        """Value of the xattr name of the file at index in the torrent described by meta"""
+        piece_length = meta.piece_length
+        first = meta.offsets[index] // piece_length
+        last = (meta.offsets[index] + max(meta.sizes[index], 1) - 1) // piece_length
+
+        if name == 'piece_length':
+            return str(piece_length).encode()
+        if name == 'piece_offset':
+            return str(meta.offsets[index] % piece_length).encode()
+
+        session = self._session  # not started just to tell nothing is downloaded
+        if name == 'rate':
+            return str(session.download_rate(meta.info_hash) if session else 0).encode()
+
+        pieces = session.have_pieces(meta.info_hash) if session else []
+        bits = pieces[first:last + 1]
+        if name == 'progress':
+            return ('%.2f' % (100 * sum(bits) / (last - first + 1))).encode()
+
+        piece_map = bytearray((last - first + 8) // 8)  # the first bit is the first piece of the file
+        for i, have in enumerate(bits):
+            if have:
+                piece_map[i >> 3] |= 0x80 >> (i & 7)
+        return bytes(piece_map)
 
-        return sub_path in paths
-        
     # Filesystem methods
     # ==================
 
-    getxattr = None
+    def getxattr(self, path, name, position=0):
+        if name not in XATTRS:
+            raise FuseOSError(errno.ENODATA)
 
-    def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        torrent_path, fake_base, sub_path = self._get_paths(full_path)
+        full_path, torrent_path, sub_path = self.resolver.resolve(path)
+        if not torrent_path:
+            raise FuseOSError(errno.ENODATA)
 
-        DIR_MASK = 0o044555
+        meta = self.metadata.get(torrent_path)
+        index = meta.tree.lookup(sub_path)
+        if not isinstance(index, int):
+            raise FuseOSError(errno.ENODATA)
 
-        if torrent_path:
-            st = os.lstat(torrent_path) # use the torrent file for permissions etc.
-            rewrite_st = list(st)
+        return self._file_xattr(meta, index, name[len(XATTR_PREFIX):])
 
-            if torrent_path and full_path.startswith(f"{fake_base}/"):
-                info = lt.torrent_info(torrent_path)
-                torrent_name = info.name()
-                torrent_files = info.files()
+    def listxattr(self, path):
+        if path in (STATS_DIR, STATS_FILE):
+            return []
 
-                for f in torrent_files:
-                    dirpath, filename = self._find_fpath(f.path, torrent_name)
+        full_path, torrent_path, sub_path = self.resolver.resolve(path)
+        if torrent_path and sub_path and isinstance(self.metadata.get(torrent_path).tree.lookup(sub_path), int):
+            return list(XATTRS)
+        return []
 
-                    if sub_path == dirpath:
-                        rewrite_st[0] = DIR_MASK
-                    elif sub_path == f"{os.path.join(dirpath, filename)}":
-                        rewrite_st[6] = f.size
+    def getattr(self, path, fh=None):
+        if path in (STATS_DIR, STATS_FILE):
+            return self._stats_attr(path)
 
-                st = os.stat_result(rewrite_st)
-            
-            else: # If it's an torrent file, present the file as an directory
-                rewrite_st[0] = DIR_MASK
+        full_path, torrent_path, sub_path = self.resolver.resolve(path)
 
-            st = os.stat_result(rewrite_st)
-        else:
+        if not torrent_path:
             st = os.lstat(full_path)
+            return dict((key, getattr(st, key)) for key in ATTRS)
 
-        return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                    'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-
-
-    def readdir(self, path, fh):
-        full_path = self._full_path(path)
-        torrent_path, fake_base, sub_path = self._get_paths(full_path)
-        sub_path = '/' if not sub_path else sub_path
+        # use the torrent file for permissions etc.
+        attrs = dict((key, getattr(self.metadata.stat(torrent_path), key)) for key in ATTRS)
 
-        dirents = ['.', '..']
+        if not sub_path:  # If it's an torrent file, present the file as an directory
+            attrs['st_mode'] = DIR_MASK
+            return attrs
 
-        if os.path.isdir(full_path):
-            dirents.extend(os.listdir(full_path))
+        meta = self.metadata.get(torrent_path)
+        node = meta.tree.lookup(sub_path)
+        if node is None:
+            raise FuseOSError(errno.ENOENT)
 
-        elif torrent_path and full_path.startswith(fake_base):
-            info = lt.torrent_info(torrent_path)
-            torrent_name = info.name()
-            torrent_files = info.files()
+        return self._node_attr(attrs, meta, sub_path, node)
 
-            for f in torrent_files:
-                dirpath, filename = self._find_fpath(f.path, torrent_name)
 
-                if sub_path == dirpath:
-                    dirents.append(filename)
+    def readdir(self, path, fh):
+        """List path with the inode number and type of every entry
 
-                    # TODO: Clean this up.. :-)
-                    for d in torrent_files:
-                        dpath, _ = self._find_fpath(d.path, torrent_name)
+        libfuse 2 passes nothing else of the attributes to the kernel, which
+        calls getattr for the rest, so no more is looked up here.
+        """
+        if path == STATS_DIR:
+            return ['.', '..', os.path.basename(STATS_FILE)]
 
-                        if dpath.startswith(dirpath):
-                            dpath = dpath.removeprefix(f"{dirpath}").lstrip('/')
-                            directory = dpath.split('/')[0]
+        full_path, torrent_path, sub_path = self.resolver.resolve(path)
 
-                            if directory and directory not in dirents:
-                                dirents.append(directory)
-        for r in dirents:
-            if r.endswith('.torrent'):
-                r = r.replace('.torrent', '')
-            yield r
+        dirents = ['.', '..']
 
+        if path == '/':
+            dirents.append((os.path.basename(STATS_DIR), self._stats_attr(STATS_DIR), 0))
+
+        if not torrent_path:
+            with os.scandir(full_path) as entries:
+                for entry in entries:
+                    if entry.name.endswith(TORRENT_EXT):
+                        name, mode = entry.name[:-len(TORRENT_EXT)], stat.S_IFDIR
+                    elif entry.is_dir(follow_symlinks=False):
+                        name, mode = entry.name, stat.S_IFDIR
+                    elif entry.is_symlink():
+                        name, mode = entry.name, stat.S_IFLNK
+                    else:
+                        name, mode = entry.name, stat.S_IFREG
+                    dirents.append((name, {'st_ino': entry.inode(), 'st_mode': mode}, 0))
+
+            return dirents
+
+        meta = self.metadata.get(torrent_path)
+        node = meta.tree.lookup(sub_path)
+
+        if not isinstance(node, dict):
+            raise FuseOSError(errno.ENOTDIR if node is not None else errno.ENOENT)
+
+        st_ino = self.metadata.stat(torrent_path).st_ino
+        for name, child in node.items():
+            mode = stat.S_IFDIR if isinstance(child, dict) else stat.S_IFREG
+            dirents.append((name, {'st_ino': virtual_ino(st_ino, f"{sub_path}/{name}"), 'st_mode': mode}, 0))
+
+        return dirents
+
+
+    def destroy(self, path):
+        if self.metrics_server:
+            self.metrics_server.stop()
+        if self.preindexer:
+            self.preindexer.stop()
+        if self.watcher:
+            self.watcher.stop()
+        if self._session:
+            self._session.close()
+        self.metadata.close()
 
     def statfs(self, path):
-        # TODO: walk the mounted path and calc fs size
-        full_path = self._full_path(path)
-        stv = os.statvfs(full_path)
-        return dict((key, getattr(stv, key)) for key in ('f_bavail', 'f_bfree',
-            'f_blocks', 'f_bsize', 'f_favail', 'f_ffree', 'f_files', 'f_flag',
-            'f_frsize', 'f_namemax'))
+        """Report the contents of the indexed torrents as used, and the space left for downloads as free
+
+        The totals are kept up to date by the metadata cache as torrents are
+        parsed and invalidated, so this does not walk the tree.
+        """
+        stv = os.statvfs(self.download_dir)
+        used = -(-self.metadata.total_bytes // stv.f_frsize)
+        return {'f_bavail': stv.f_bavail, 'f_bfree': stv.f_bfree, 'f_blocks': used + stv.f_bfree,
+                'f_bsize': stv.f_bsize, 'f_favail': 0, 'f_ffree': 0, 'f_files': self.metadata.total_files,
+                'f_flag': os.ST_RDONLY, 'f_frsize': stv.f_frsize, 'f_namemax': stv.f_namemax}
 
     # File methods
     # ============
 
     def open(self, path, flags):
-        full_path = self._full_path(path)
-        torrent_path, fake_base, sub_path = self._get_paths(full_path)
-        dirpath, filename = os.path.split(full_path)
+        if path == STATS_FILE:
+            fh = next(self._fh)
+            self.handles[fh] = self._stats_json()
+            return fh
+
+        full_path, torrent_path, sub_path = self.resolver.resolve(path)
 
-        logger.debug(f"Open path: {path}")
+        logger.debug("Open path: %s", path)
 
         if torrent_path:
-            logger.debug(f"Found torrent: {torrent_path}")
-            torrent_full_path = os.path.abspath(torrent_path)
+            logger.debug("Found torrent: %s", torrent_path)
 
-            if self._file_in_torrent(sub_path, torrent_full_path): 
-                return True
+            meta = self.metadata.get(torrent_path)
+            index = meta.tree.lookup(sub_path)
 
-            return False
+            if not isinstance(index, int):
+                raise FuseOSError(errno.ENOENT)
+
+            try:
+                handle = self.torrent_session.open_file(torrent_path, index, meta=meta,
+                                                        nonblocking=bool(flags & os.O_NONBLOCK))
+            except ReadTimeout as e:
+                logger.warning(f"Open of {path} timed out: {e}")
+                raise FuseOSError(errno.ETIMEDOUT)
         else:
-            return os.open(full_path, flags)
+            handle = os.open(full_path, flags)
+
+        fh = next(self._fh)
+        self.handles[fh] = handle
+        return fh
 
     # https://gist.github.com/tizbac/2df2609726d6058b3c99
     def read(self, path, length, offset, fh):
-        full_path = self._full_path(path)
-        torrent_path, fake_base, sub_path = self._get_paths(full_path)
-        dirpath, filename = os.path.split(full_path)
-
-        logger.debug(f"Read path: {path}")
-
-        if torrent_path:
-            logger.debug(f"Found torrent: {torrent_path}")
-            torrent_full_path = os.path.abspath(torrent_path)
-
-            if not self._file_in_torrent(sub_path, torrent_full_path): return False
-            
-            with self._open_torrent(torrent_full_path) as torrent:
-                torrent_file = next((f for f in torrent if os.path.split(f.path)[1] == filename), None)
-
-                if torrent_file:
-                    logger.debug(f"Reading file: {filename} | Length: {length} | Offset: {offset}")
-                    return torrent_file.read(length, offset)
-        else:
-            os.lseek(fh, offset, os.SEEK_SET)
-            return os.read(fh, length)
-
-def main(mountpoint, root):
-    FUSE(TorrentFS(root), mountpoint, foreground=True, ro=True, allow_other=True) #, threaded=True)
+        handle = self.handles[fh]
+
+        if isinstance(handle, int):
+            data = os.pread(handle, length, offset)
+            self.metrics.add('bytes_passthrough', len(data))
+            return data
+
+        if isinstance(handle, bytes):
+            return handle[offset:offset + length]
+
+        try:
+            return handle.read(length, offset)
+        except BlockingIOError:  # opened with O_NONBLOCK, the pieces are scheduled now
+            raise FuseOSError(errno.EAGAIN)
+        except ReadTimeout as e:
+            logger.warning(f"Read of {path} timed out: {e}")
+            raise FuseOSError(errno.ETIMEDOUT)
+        except TorrentError as e:
+            logger.warning(f"Read of {path} failed: {e}")
+            raise FuseOSError(errno.EIO)
+
+    def release(self, path, fh):
+        handle = self.handles.pop(fh, None)
+
+        if isinstance(handle, int):
+            os.close(handle)
+        elif handle and not isinstance(handle, bytes):
+            handle.close()
+
+def main(mountpoint, root, index_path=None, cache_ttl=CACHE_TTL, threaded=True, metrics_port=None,
+         preindex_workers=0, max_read=MAX_READ, watch=False, attr_timeout=None, daemon=None, session_args=None):
+    if attr_timeout is None:  # the kernel may serve stats as stale as the mount's own caches
+        attr_timeout = cache_ttl
+
+    FUSE(TorrentFS(root, index_path=index_path, cache_ttl=cache_ttl, metrics_port=metrics_port,
+                   preindex_workers=preindex_workers, watch=watch, daemon=daemon, session_args=session_args),
+         mountpoint, foreground=True, ro=True, allow_other=True, nothreads=not threaded,
+         max_read=max_read, max_readahead=max_read,
+         use_ino=True, attr_timeout=attr_timeout, entry_timeout=attr_timeout)
 
 if __name__ == '__main__':
     # parse args
@@ -224,6 +390,25 @@ if __name__ == '__main__':
     parser.add_argument("mountpoint", help="Path to target mountpoint")
     parser.add_argument("root", help="Path to root directory")
     parser.add_argument("-v", "--verbose", help="Set loglevel to debug", action="store_true")
+    parser.add_argument("--index", help="Path to an on-disk torrent metadata index",
+                        default=os.environ.get('INDEX'))
+    parser.add_argument("-s", "--single-threaded", help="Serve filesystem requests from a single thread",
+                        action="store_true", default=bool(os.environ.get('SINGLE_THREADED')))
+    parser.add_argument("--cache-ttl", help="Seconds before the source tree is checked for changes again",
+                        type=float, default=float(os.environ.get('CACHE_TTL', CACHE_TTL)))
+    parser.add_argument("--metrics-port", help="Serve Prometheus metrics on this local port",
+                        type=int, default=int(os.environ.get('METRICS_PORT', 0)) or None)
+    parser.add_argument("--preindex", help="Parse every torrent below root with this many threads at mount time",
+                        type=int, metavar="WORKERS", default=int(os.environ.get('PREINDEX', 0)))
+    parser.add_argument("--max-read", help="Largest read request in KiB to negotiate with the kernel",
+                        type=int, default=int(os.environ.get('MAX_READ', MAX_READ // 1024)))
+    parser.add_argument("-w", "--watch", help="Watch the source tree with inotify instead of polling it",
+                        action="store_true", default=bool(os.environ.get('WATCH')))
+    parser.add_argument("--attr-timeout", help="Seconds the kernel caches attributes and lookups, --cache-ttl if not set",
+                        type=float, default=float(os.environ['ATTR_TIMEOUT']) if 'ATTR_TIMEOUT' in os.environ else None)
+    parser.add_argument("--daemon", help="Unix socket of a torrentdaemon.py to share the torrent session of, "
+                        "which then takes the session options instead", default=os.environ.get('DAEMON'))
+    add_session_arguments(parser)
     args = parser.parse_args()
 
     # set logging
@@ -238,4 +423,7 @@ if __name__ == '__main__':
     else:
         logger.setLevel(logging.INFO)
 
-    main(args.mountpoint, args.root)
\ No newline at end of file
+    main(args.mountpoint, args.root, index_path=args.index, cache_ttl=args.cache_ttl,
+         threaded=not args.single_threaded, metrics_port=args.metrics_port, preindex_workers=args.preindex,
+         max_read=args.max_read * 1024, watch=args.watch, attr_timeout=args.attr_timeout, daemon=args.daemon,
+         session_args=session_options(args))
@@ -0,0 +1,617 @@
+"""Metadata index for .torrent files found in the source tree"""
+import os
+import sys
+import json
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import logging
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+
+import libtorrent as lt
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 1024
+CACHE_TTL = 1.0  # seconds between revalidations of the source tree
+WATCH_TTL = 60.0  # revalidation interval when changes are pushed by a SourceWatcher
+
+TORRENT_EXT = '.torrent'
+
+PAYLOAD_PROBES = 16  # largest files of a torrent looked for when searching for a local payload
+
+Resolved = namedtuple('Resolved', ['full_path', 'torrent_path', 'sub_path'])
+
+
+class TorrentTree:
+    """Trie of path segments for the files in a torrent
+
+    Directories are dicts mapping an interned name to either another
+    directory or to the integer index of a file in the torrent. The root
+    folder of multi-file torrents is stripped, so the tree describes what
+    is presented below the expanded .torrent directory.
+    """
+    def __init__(self, name, paths):
+        self.root = {}
+
+        for index, path in enumerate(paths):
+            parts = path.split('/')
+            if len(parts) > 1 and parts[0] == name:
+                parts = parts[1:]
+
+            node = self.root
+            for part in parts[:-1]:
+                node = node.setdefault(sys.intern(part), {})
+            node[sys.intern(parts[-1])] = index
+
+    def lookup(self, sub_path):
+        """Return the directory dict or file index at sub_path, None if missing"""
+        node = self.root
+
+        for part in sub_path.split('/'):
+            if not part:
+                continue
+            if not isinstance(node, dict):
+                return None
+            node = node.get(part)
+            if node is None:
+                return None
+
+        return node
+
+
+class TorrentMeta:
+    """Parsed, immutable view of a .torrent file"""
+    def __init__(self, name, info_hash, piece_length, num_pieces, paths, sizes, offsets):
+        self.name = name
+        self.info_hash = info_hash
+        self.piece_length = piece_length
+        self.num_pieces = num_pieces
+        self.paths = tuple(paths)
+        self.sizes = array('q', sizes)
+        self.offsets = array('q', offsets)
+
+    def __repr__(self):
+        return f"{self.name} ({self.info_hash})"
+
+    def __len__(self):
+        return len(self.paths)
+
+    @cached_property
+    def tree(self):
+        """Directory tree of the files in this torrent"""
+        return TorrentTree(self.name, self.paths)
+
+    @classmethod
+    def from_file(cls, torrent_path):
+        """Bencode-decode a .torrent file"""
+        return cls.from_info(lt.torrent_info(torrent_path))
+
+    @classmethod
+    def from_info(cls, info):
+        """Build from an already parsed `libtorrent.torrent_info`"""
+        storage = info.files()
+        num_files = range(storage.num_files())
+
+        return cls(info.name(), str(info.info_hash()), info.piece_length(), info.num_pieces(),
+                   [storage.file_path(i) for i in num_files],
+                   [storage.file_size(i) for i in num_files],
+                   [storage.file_offset(i) for i in num_files])
+
+    @classmethod
+    def loads(cls, data):
+        """Restore from the on-disk index representation"""
+        return cls(**json.loads(data))
+
+    def dumps(self):
+        """Serialize for the on-disk index"""
+        return json.dumps({
+            'name': self.name,
+            'info_hash': self.info_hash,
+            'piece_length': self.piece_length,
+            'num_pieces': self.num_pieces,
+            'paths': self.paths,
+            'sizes': self.sizes.tolist(),
+            'offsets': self.offsets.tolist(),
+        })
+
+
+def find_payload(meta, torrent_path, search_dirs):
+    """Return the directory holding a local copy of the payload of meta, or None
+
+    Relative search directories are relative to the directory of the .torrent
+    file, so '.' finds payloads next to it. A directory qualifies when one
+    of the torrent's largest files is found below it with its full size, the
+    content is only verified as it is read.
+    """
+    largest = sorted(range(len(meta)), key=meta.sizes.__getitem__, reverse=True)[:PAYLOAD_PROBES]
+
+    for directory in search_dirs:
+        directory = os.path.normpath(os.path.join(os.path.dirname(torrent_path), directory))
+        for index in largest:
+            try:
+                if os.stat(os.path.join(directory, meta.paths[index])).st_size == meta.sizes[index]:
+                    return directory
+            except OSError:
+                continue
+
+    return None
+
+
+class MetadataCache:
+    """LRU of parsed torrents keyed by path and validated by (inode, size, mtime)
+
+    The .torrent file is stat'ed again once its cached stat is older than
+    `ttl`, so a replaced or edited torrent is re-parsed shortly after it
+    changes. When `index_path` is set, parsed entries are also kept in a
+    sqlite database so a remount does not re-parse everything. A torrent is
+    parsed by one thread at a time, others asking for it wait for the result.
+
+    `total_bytes` and `total_files` count the contents of every torrent
+    parsed so far, including those since evicted from memory. They are kept
+    up to date as torrents are parsed, replaced and invalidated, so they
+    can be read without walking the tree.
+    """
+    def __init__(self, max_size=CACHE_SIZE, index_path=None, ttl=CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._stats = OrderedDict()
+        self._parsing = {}  # path -> Event set once the thread parsing it is done
+        self._totals = {}  # path -> (bytes, files) counted in total_bytes and total_files
+        self.total_bytes = 0
+        self.total_files = 0
+        self._lock = threading.Lock()
+        self._db = None
+
+        if index_path:
+            self._db = sqlite3.connect(index_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS torrents ("
+                             "path TEXT PRIMARY KEY, ino INTEGER, size INTEGER, "
+                             "mtime INTEGER, meta TEXT)")
+            self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def reserve(self, size):
+        """Grow the LRU to hold at least size parsed torrents"""
+        with self._lock:
+            self.max_size = max(self.max_size, size)
+
+    @staticmethod
+    def _key(st):
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def stat(self, torrent_path):
+        """Return a recent `os.stat_result` of torrent_path"""
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._stats.get(torrent_path)
+            if entry and now - entry[1] < self.ttl:
+                return entry[0]
+
+        try:
+            st = os.stat(torrent_path)
+        except FileNotFoundError:
+            with self._lock:
+                self._count(torrent_path, None)
+            raise
+
+        with self._lock:
+            self._stats[torrent_path] = (st, now)
+            self._stats.move_to_end(torrent_path)
+            while len(self._stats) > self.max_size * 16:
+                self._stats.popitem(last=False)
+
+        return st
+
+    def get(self, torrent_path):
+        """Return the `TorrentMeta` for torrent_path, parsing it if needed"""
+        key = self._key(self.stat(torrent_path))
+
+        while True:
+            with self._lock:
+                entry = self._entries.get(torrent_path)
+                if entry and entry[0] == key:
+                    self._entries.move_to_end(torrent_path)
+                    return entry[1]
+
+                parsing = self._parsing.get(torrent_path)
+                if parsing is None:
+                    parsing = self._parsing[torrent_path] = threading.Event()
+                    break
+
+            parsing.wait()  # another thread, like the pre-indexer, is parsing it
+
+        try:
+            meta = self._load(torrent_path, key)
+            if not meta:
+                logger.debug("Parsing torrent: %s", torrent_path)
+                meta = TorrentMeta.from_file(torrent_path)
+                self._store(torrent_path, key, meta)
+
+            with self._lock:
+                self._entries[torrent_path] = (key, meta)
+                self._entries.move_to_end(torrent_path)
+                self._count(torrent_path, meta)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        finally:
+            with self._lock:
+                self._parsing.pop(torrent_path).set()
+
+        return meta
+
+    def expire(self):
+        """Forget every cached stat, so each torrent is revalidated on its next lookup"""
+        with self._lock:
+            self._stats.clear()
+
+    def invalidate(self, torrent_path):
+        """Drop torrent_path from memory and from the on-disk index"""
+        with self._lock:
+            self._entries.pop(torrent_path, None)
+            self._stats.pop(torrent_path, None)
+            self._count(torrent_path, None)
+            if self._db:
+                self._db.execute("DELETE FROM torrents WHERE path = ?", (torrent_path,))
+                self._db.commit()
+
+    def invalidate_tree(self, directory):
+        """Drop every torrent below directory from memory and from the on-disk index"""
+        prefix = os.path.join(directory, '')
+        with self._lock:
+            for torrent_path in [p for p in {*self._entries, *self._stats, *self._totals} if p.startswith(prefix)]:
+                self._entries.pop(torrent_path, None)
+                self._stats.pop(torrent_path, None)
+                self._count(torrent_path, None)
+            if self._db:
+                self._db.execute("DELETE FROM torrents WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+                self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
+
+    def _count(self, torrent_path, meta):
+        """Replace what torrent_path adds to the totals by meta, or remove it. Hold _lock"""
+        size, files = self._totals.pop(torrent_path, (0, 0))
+        self.total_bytes -= size
+        self.total_files -= files
+
+        if meta is not None:
+            size, files = sum(meta.sizes), len(meta)
+            self._totals[torrent_path] = (size, files)
+            self.total_bytes += size
+            self.total_files += files
+
+    def _load(self, torrent_path, key):
+        if not self._db:
+            return None
+
+        with self._lock:
+            row = self._db.execute("SELECT ino, size, mtime, meta FROM torrents WHERE path = ?",
+                                   (torrent_path,)).fetchone()
+
+        if row and tuple(row[:3]) == key:
+            return TorrentMeta.loads(row[3])
+
+        return None
+
+    def _store(self, torrent_path, key, meta):
+        if not self._db:
+            return
+
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO torrents VALUES (?, ?, ?, ?, ?)",
+                             (torrent_path, *key, meta.dumps()))
+            self._db.commit()
+
+
+class PathResolver:
+    """Maps virtual paths below the mountpoint to torrents or plain files
+
+    The names of the .torrent files in each source directory are cached and
+    only rescanned when the directory's mtime changes, which is checked at
+    most once per `ttl`. Resolved paths, both torrent-backed and plain
+    passthrough ones, are cached for `ttl` as well, so repeated lookups of
+    the same paths do not touch the source filesystem at all. Torrents
+    missing from a rescan, or below a subdirectory missing from it, are
+    dropped from `metadata`, so its totals do not count deleted or renamed
+    torrents.
+    """
+    def __init__(self, root, ttl=CACHE_TTL, max_size=CACHE_SIZE * 16, metadata: MetadataCache = None):
+        self.root = os.path.abspath(root)
+        self.ttl = ttl
+        self.metadata = metadata
+        self.max_size = max_size
+        self._dirs = {}
+        self._paths = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, path):
+        """Return a `Resolved` for the virtual path
+
+        `torrent_path` is None for passthrough paths. For torrent-backed
+        paths `sub_path` is the path inside the torrent, or '' for the
+        directory the .torrent file is expanded into.
+        """
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._paths.get(path)
+            if entry and now - entry[1] < self.ttl:
+                self._paths.move_to_end(path)
+                return entry[0]
+
+        resolved = self._resolve(path, now)
+
+        with self._lock:
+            self._paths[path] = (resolved, now)
+            self._paths.move_to_end(path)
+            while len(self._paths) > self.max_size:
+                self._paths.popitem(last=False)
+
+        return resolved
+
+    def invalidate(self, directory=None):
+        """Forget cached state for a source directory and those below it, or everything"""
+        with self._lock:
+            if directory is None:
+                self._dirs.clear()
+            else:
+                prefix = os.path.join(directory, '')
+                for path in [d for d in self._dirs if d == directory or d.startswith(prefix)]:
+                    del self._dirs[path]
+            self._paths.clear()
+
+    def _resolve(self, path, now):
+        parts = [p for p in path.split('/') if p]
+        current = self.root
+
+        for i, part in enumerate(parts):
+            if part in self._torrents_in(current, now):
+                sub_path = '/'.join(parts[i + 1:])
+                return Resolved(os.path.join(current, *parts[i:]),
+                                os.path.join(current, part + TORRENT_EXT),
+                                f"/{sub_path}" if sub_path else '')
+            current = os.path.join(current, part)
+
+        return Resolved(current, None, None)
+
+    def _torrents_in(self, directory, now):
+        """Return the names of the .torrent files in directory, without extension"""
+        entry = self._dirs.get(directory)
+        if entry and now - entry[0] < self.ttl:
+            return entry[2]
+
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if entry and entry[1] == mtime:
+            names, subdirs = entry[2], entry[3]
+        else:
+            names, subdirs = self._scan(directory) if mtime is not None else (frozenset(), frozenset())
+            if entry:
+                # the directory changed, so paths resolved through it may be stale
+                with self._lock:
+                    self._paths.clear()
+                for name in entry[2] - names if self.metadata else ():
+                    self.metadata.invalidate(os.path.join(directory, name + TORRENT_EXT))
+                for name in entry[3] - subdirs if self.metadata else ():
+                    self.metadata.invalidate_tree(os.path.join(directory, name))
+
+        self._dirs[directory] = (now, mtime, names, subdirs)
+        return names
+
+    @staticmethod
+    def _scan(directory):
+        """Return the names of the .torrent files in directory, without extension, and of its subdirectories"""
+        names, subdirs = set(), set()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(TORRENT_EXT) and entry.is_file():
+                        names.add(entry.name[:-len(TORRENT_EXT)])
+                    elif entry.is_dir(follow_symlinks=False):
+                        subdirs.add(entry.name)
+        except OSError:
+            pass
+        return frozenset(names), frozenset(subdirs)
+
+
+class PreIndexer(threading.Thread):
+    """Walks the source tree once and parses every torrent in a thread pool
+
+    Each directory is resolved and each .torrent file is parsed and has its
+    tree built ahead of time, so the first listing of a torrent directory
+    finds its entry ready. Lookups of torrents the crawler has not reached
+    yet still parse on demand, or wait for a parse already running. The
+    `MetadataCache` grows to hold every torrent found, so none of them is
+    evicted and parsed again on its first listing.
+    """
+    def __init__(self, root, metadata: MetadataCache, resolver: PathResolver, workers=4):
+        super().__init__(name='pre-indexer', daemon=True)
+        self.root = os.path.abspath(root)
+        self.metadata = metadata
+        self.resolver = resolver
+        self.workers = workers
+        self.indexed = 0
+        self.found = 0
+        self._stopped = threading.Event()
+
+    def run(self):
+        start = time.monotonic()
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix='pre-indexer') as executor:
+            for directory, _, files in os.walk(self.root):
+                if self._stopped.is_set():
+                    break
+
+                relative = os.path.relpath(directory, self.root)
+                self.resolver.resolve('/' if relative == '.' else '/' + relative)
+                for name in files:
+                    if name.endswith(TORRENT_EXT):
+                        self.found += 1
+                        self.metadata.reserve(self.found)
+                        executor.submit(self._index, os.path.join(directory, name))
+
+        logger.info("Pre-indexed %d torrents in %.1fs", self.indexed, time.monotonic() - start)
+
+    def _index(self, torrent_path):
+        if self._stopped.is_set():
+            return
+        try:
+            self.metadata.get(torrent_path).tree
+            self.indexed += 1
+        except Exception:
+            logger.warning("Failed to pre-index %s", torrent_path, exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class SourceWatcher(threading.Thread):
+    """Pushes changes below the source root into the metadata and path caches
+
+    Uses inotify through ctypes to watch every source directory. A .torrent
+    file that is created, rewritten, moved or deleted is dropped from the
+    `MetadataCache`, so only that torrent is parsed again, and the path
+    cache of its directory is invalidated. A directory moved out of the tree
+    takes the torrents below it and their watches along. `on_removed(path)`
+    is called with the path of a .torrent file, or of a directory, that
+    disappeared. Raises OSError when inotify is not available, callers then
+    keep relying on the caches' ttl.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT = struct.Struct('iIII')  # wd, mask, cookie, len, followed by the name
+
+    def __init__(self, root, metadata: MetadataCache, resolver: PathResolver, on_removed=None):
+        super().__init__(name='source-watcher', daemon=True)
+        self.root = os.path.abspath(root)
+        self.metadata = metadata
+        self.resolver = resolver
+        self.on_removed = on_removed
+        self._watches = {}  # watch descriptor -> directory
+        self._stopped = threading.Event()
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self._watch_tree(self.root)
+
+    def _watch_tree(self, top):
+        for directory, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                logger.warning("Can not watch %s: %s", directory, os.strerror(ctypes.get_errno()))
+                continue
+            self._watches[wd] = directory
+
+    def _unwatch_tree(self, top):
+        prefix = os.path.join(top, '')
+        for wd, directory in list(self._watches.items()):
+            if directory == top or directory.startswith(prefix):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._watches[wd]
+
+    def run(self):
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self.fd], [], [], 1.0)
+            if not readable:
+                continue
+
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0')
+                offset += self.EVENT.size + length
+
+                try:
+                    self._handle(wd, mask, os.fsdecode(name))
+                except Exception:
+                    logger.exception("Failed to handle change in %s", self._watches.get(wd))
+
+        os.close(self.fd)
+
+    def _handle(self, wd, mask, name):
+        if mask & self.IN_Q_OVERFLOW:  # events were lost, revalidate everything
+            logger.warning("Missed changes below %s", self.root)
+            self.metadata.expire()
+            self.resolver.invalidate()
+            return
+
+        directory = self._watches.get(wd)
+        if directory is None:
+            return
+
+        if mask & self.IN_IGNORED:
+            del self._watches[wd]
+            return
+
+        if mask & (self.IN_DELETE_SELF | self.IN_ISDIR):
+            path = os.path.join(directory, name) if name else directory
+            logger.debug("Directory changed: %s", path)
+            self.resolver.invalidate(path)
+            self.resolver.invalidate(os.path.dirname(path))
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self._watch_tree(path)
+            elif mask & self.IN_ISDIR and mask & self.IN_MOVED_FROM:
+                # moved elsewhere, maybe out of the tree, its old paths are gone
+                self._unwatch_tree(path)
+                self.metadata.invalidate_tree(path)
+                if self.on_removed:
+                    self.on_removed(path)
+            return
+
+        if not name.endswith(TORRENT_EXT):
+            return
+
+        path = os.path.join(directory, name)
+        logger.debug("Torrent changed: %s", path)
+        self.metadata.invalidate(path)
+
+        if mask & (self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO):
+            self.resolver.invalidate(directory)
+
+        if mask & (self.IN_DELETE | self.IN_MOVED_FROM) and self.on_removed:
+            self.on_removed(path)
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,147 @@
+"""Low overhead counters and latency histograms for the filesystem"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds of the latency histogram buckets, the last one is +Inf
+BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+STATS_TTL = 1.0  # seconds a rendered stats snapshot is reused
+
+
+class Histogram:
+    """Count, sum and bucketed distribution of observed durations"""
+    __slots__ = ('count', 'sum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.buckets[bisect_left(BUCKETS, seconds)] += 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([str(b) for b in BUCKETS] + ['+Inf'], self.buckets)),
+        }
+
+
+class Metrics:
+    """Latency histograms and counters shared by the filesystem and the torrent session
+
+    `observe` and `add` only take a lock and update a few integers, so they
+    are cheap enough to call for every filesystem operation.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {}  # name -> Histogram
+        self.counters = {}  # name -> int
+        self.gauges = {}  # name -> callable returning the current value
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        """Record a duration in the histogram called name"""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def add(self, name, value=1):
+        """Increment the counter called name"""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, function):
+        """Report the value returned by function as name in every snapshot"""
+        with self._lock:
+            self.gauges[name] = function
+
+    def snapshot(self, session=None):
+        """Return every metric as a dict, with per-torrent status from session"""
+        with self._lock:
+            result = {
+                'uptime': time.time() - self.started,
+                'latency': {name: h.to_dict() for name, h in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items())),
+            }
+            gauges = sorted(self.gauges.items())
+
+        result['gauges'] = {name: function() for name, function in gauges}
+
+        if session is not None:
+            result['torrents'] = {torrent.info_hash: torrent.status for torrent in session}
+        return result
+
+    def to_json(self, session=None):
+        return json.dumps(self.snapshot(session), indent=2).encode() + b'\n'
+
+    def to_prometheus(self, session=None):
+        """Render the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot(session)
+        lines = ['# TYPE torrentfs_latency_seconds histogram']
+
+        for name, histogram in snapshot['latency'].items():
+            cumulative = 0
+            for bound, count in histogram['buckets'].items():
+                cumulative += count
+                lines.append(f'torrentfs_latency_seconds_bucket{{op="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'torrentfs_latency_seconds_sum{{op="{name}"}} {histogram["sum"]}')
+            lines.append(f'torrentfs_latency_seconds_count{{op="{name}"}} {histogram["count"]}')
+
+        lines.append('# TYPE torrentfs_total counter')
+        for name, value in snapshot['counters'].items():
+            lines.append(f'torrentfs_total{{name="{name}"}} {value}')
+
+        lines.append('# TYPE torrentfs_gauge gauge')
+        for name, value in snapshot['gauges'].items():
+            lines.append(f'torrentfs_gauge{{name="{name}"}} {value}')
+
+        lines.append('# TYPE torrentfs_torrent gauge')
+        for info_hash, status in snapshot.get('torrents', {}).items():
+            for key, value in (status or {}).items():
+                if isinstance(value, (int, float)):
+                    lines.append(f'torrentfs_torrent{{info_hash="{info_hash}",name="{key}"}} {value}')
+
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class MetricsServer(threading.Thread):
+    """Serve `Metrics.to_prometheus` over HTTP on a local port"""
+    def __init__(self, metrics: Metrics, session=None, port=9150, host='127.0.0.1'):
+        super().__init__(name='metrics-server', daemon=True)
+        self.metrics = metrics
+        self.session = session
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = server.metrics.to_prometheus(server.session)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
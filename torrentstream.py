@@ -2,23 +2,48 @@
 from urllib.parse import quote
 import tempfile
 import os
+import errno
+import hashlib
+import shutil
 import time
+import threading
 from datetime import datetime
 import logging
 import mimetypes
-from collections import namedtuple
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
 from random import randint
 
 import libtorrent as lt
 
+from torrentindex import TorrentMeta, find_payload
+from torrentmetrics import Metrics
+
 mimetypes.init()
+mimetypes.add_type('video/x-matroska', '.mkv')
+mimetypes.add_type('audio/x-matroska', '.mka')
+mimetypes.add_type('audio/flac', '.flac')
 
 STATUSES = [
     'queued', 'checking', 'downloading_metadata', 'downloading', 'finished',
     'seeding', 'allocating', 'checking_fastresume'
 ]
 
+SNAPSHOT_TTL = 1.0  # seconds batched per-file progress and priorities are reused
+
+RESUME_INTERVAL = 60  # seconds between fast-resume saves of modified torrents
+
+MAX_ACTIVE = 8  # torrents downloading at the same time
+IDLE_TIMEOUT = 300  # seconds without reads before a torrent is paused, and again before it is removed
+READ_TIMEOUT = 120  # seconds a read waits for pieces before failing, 0 waits forever
+STALL_TIMEOUT = 15  # seconds without progress on awaited pieces before looking for peers again
+ERROR_RETRY = 30  # seconds before a torrent libtorrent stopped with an error is resumed again
+
+DEFAULT_PRIORITY = 4  # libtorrent's default piece priority
+
 TRACKERS = ("udp://tracker.openbittorrent.com:80/announce",
             "udp://tracker.publicbt.com:80/announce")
 
@@ -26,9 +51,78 @@ DHT = (("router.utorrent.com", 6881), ("router.bittorrent.com", 6881),
        ("dht.transmissionbt.com", 6881), ("router.bitcomet.com",
                                           6881), ("dht.aelitis.com", 6881))
 
-EXTENSIONS = ('ut_pex', 'ut_metadata', 'smart_ban', 'metadata_transfoer')
-
-PORTS = (randint(20000, 25000), randint(30000, 35000))
+PORT_RANGE = (20000, 25000)  # a random listen port is picked from here unless one is given
+
+ALERT_MASK = (lt.alert.category_t.error_notification |
+              lt.alert.category_t.status_notification |
+              lt.alert.category_t.storage_notification |
+              lt.alert.category_t.piece_progress_notification)
+
+# libtorrent settings_pack values applied on top of the defaults
+# https://www.libtorrent.org/reference-Settings.html
+PROFILES = {
+    # request little ahead of time from many peers and give up on slow ones
+    # quickly, so the pieces a player is waiting for arrive first
+    'streaming-low-latency': {
+        'max_out_request_queue': 500,
+        'request_queue_time': 1,
+        'piece_timeout': 5,
+        'request_timeout': 10,
+        'peer_timeout': 60,
+        'strict_end_game_mode': False,
+        'connections_limit': 200,
+        'unchoke_slots_limit': 8,
+        'max_queued_disk_bytes': 4 * 1024 * 1024,
+        'send_buffer_watermark': 1024 * 1024,
+    },
+    # deep request queues and many connections, for downloading whole torrents
+    'bulk-throughput': {
+        'max_out_request_queue': 3000,
+        'request_queue_time': 5,
+        'piece_timeout': 20,
+        'request_timeout': 60,
+        'strict_end_game_mode': True,
+        'connections_limit': 500,
+        'unchoke_slots_limit': 16,
+        'max_queued_disk_bytes': 32 * 1024 * 1024,
+        'send_buffer_watermark': 4 * 1024 * 1024,
+    },
+    # small buffers and few peers, for constrained hosts
+    'low-memory': {
+        'max_out_request_queue': 100,
+        'request_queue_time': 2,
+        'piece_timeout': 10,
+        'strict_end_game_mode': True,
+        'connections_limit': 50,
+        'unchoke_slots_limit': 4,
+        'max_peerlist_size': 500,
+        'max_queued_disk_bytes': 512 * 1024,
+        'send_buffer_watermark': 128 * 1024,
+        'send_buffer_low_watermark': 16 * 1024,
+    },
+}
+
+PROFILE = 'streaming-low-latency'
+
+MiB = 1024 * 1024
+
+# (head, tail) bytes prefetched when a file is opened, by mime type or its major type
+PREFETCH_POLICIES = {
+    'video': (8 * MiB, 8 * MiB),  # container headers, and MP4 moov atoms or MKV cues at the end
+    'audio': (1 * MiB, 128 * 1024),  # ID3v2 tags at the start, ID3v1 and APE tags at the end
+    'image': (1 * MiB, 0),
+    'application/zip': (64 * 1024, 1 * MiB),  # the central directory is at the end
+    'application/x-rar-compressed': (1 * MiB, 0),
+    'application/vnd.rar': (1 * MiB, 0),
+    'application/x-tar': (1 * MiB, 0),
+}
+READ_BLOCK = 1 * MiB  # bytes read from a payload file at once, to serve adjacent reads from memory
+PROBE_BUDGET = 256 * MiB  # bytes of prefetches outstanding at once
+PREFETCH_TIMEOUT = 60  # seconds before an unfinished prefetch gives its budget back
+
+# priority classes of readers in the PieceScheduler
+INTERACTIVE = 'interactive'
+BACKGROUND = 'background'
 
 
 ############################
@@ -40,88 +134,338 @@ PORTS = (randint(20000, 25000), randint(30000, 35000))
 #  ----- DISCLAMIER -----  #
 ############################
 
-def get_indexed(func):
-    """Return currently indedex torrent"""
-    def inner(*args, **kwargs):
-        """Executes a method, and returns result[class_instance.index]"""
-        return list(func(*args, **kwargs)())[args[0].index]
+class TorrentError(Exception):
+    """Raised to waiters when libtorrent reports an error for a torrent"""
+
 
-    return inner
+class ReadTimeout(TorrentError):
+    """Raised when pieces a read waits for are not downloaded within the read timeout"""
 
 
 class TorrentSession:
     """Represent a torrent session. May handle multiple torrents"""
-    def __init__(self, ports=PORTS, extensions=EXTENSIONS, dht_routers=DHT):
-        self.session = lt.session()
-        #self.session.set_severity_level(lt.alert.severity_levels.critical)
-        self.session.listen_on(*ports)
-        for extension in extensions:
-            self.session.add_extension(extension)
-        self.session.start_dht()
-        self.session.start_lsd()
-        self.session.start_upnp()
-        self.session.start_natpmp()
-        for router in dht_routers:
-            self.session.add_dht_router(*router)
-        self.torrents = []
-
-    def __exit__(self):
-        """ Remove all torrents on exit """
-        logger.debug(f"Cleaning up torrents: {self.torrents}")
-        for torrent in self.torrents:
-            if torrent.temp_dir and torrent.remove_after:
-                torrent.temp_dir.cleanup()
-
-                self.session.remove_torrent(torrent.handle)
-    
+    def __init__(self, port=None, dht_routers=DHT, profile=PROFILE, settings=None, piece_cache_size=0,
+                 cache_dir=None, cache_size=0, resume_interval=RESUME_INTERVAL,
+                 max_active=MAX_ACTIVE, idle_timeout=IDLE_TIMEOUT, metrics=None, peers=(),
+                 probe_budget=PROBE_BUDGET, read_timeout=READ_TIMEOUT, stall_timeout=STALL_TIMEOUT,
+                 payload_dirs=(), trackers=TRACKERS):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown settings profile: {profile}")
+
+        self.port = port or randint(*PORT_RANGE)
+        self.profile = profile
+        self.session = lt.session({
+            'listen_interfaces': f"0.0.0.0:{self.port},[::]:{self.port}",
+            'enable_dht': True,
+            'enable_lsd': True,
+            'enable_upnp': True,
+            'enable_natpmp': True,
+            'dht_bootstrap_nodes': ','.join(f"{host}:{port}" for host, port in dht_routers),
+            'alert_mask': ALERT_MASK,
+            # the lifecycle decides what runs, libtorrent's queue must not hold torrents back
+            'active_downloads': max_active,
+            'active_seeds': max_active,
+            'active_limit': max_active * 2,
+            **PROFILES[profile],
+            **(settings or {}),
+        })
+        self.torrents = {}  # info hash -> Torrent
+        self.metrics = metrics or Metrics()
+        self.peers = tuple(peers)  # (host, port) every torrent connects to, besides the ones it finds
+        self.read_timeout = read_timeout
+        self.stall_timeout = stall_timeout
+        self.payload_dirs = tuple(payload_dirs)  # where to look for local copies of payloads
+        self.trackers = tuple(trackers)  # announced to by every torrent, besides its own
+        self.scheduler = PieceScheduler(self)
+        self.prefetcher = Prefetcher(probe_budget, self.metrics)
+        self.lifecycle = TorrentLifecycle(self, max_active, idle_timeout)
+        self.piece_cache = PieceCache(piece_cache_size) if piece_cache_size else None
+        self.download_cache = DownloadCache(cache_dir, cache_size) if cache_dir else None
+        self._downloaded_bytes = 0  # of the torrents in the session without a download cache, updated by maintain
+        self._lock = threading.RLock()
+        self.dispatcher = AlertDispatcher(self)
+        self.dispatcher.start()
+        self.maintainer = SessionMaintainer(self, interval=resume_interval)
+        self.maintainer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self, timeout=10):
+        """ Save fast-resume data and remove all torrents """
+        logging.debug(f"Cleaning up torrents: {self.torrents}")
+        with self._lock:
+            torrents, self.torrents = list(self.torrents.values()), {}
+
+        saving = [torrent.save_resume_data() for torrent in torrents]
+        deadline = time.monotonic() + timeout
+        for event in filter(None, saving):
+            event.wait(max(0, deadline - time.monotonic()))
+
+        self.maintainer.stop()
+        self.dispatcher.stop()
+        self.prefetcher.close()
+        for torrent in torrents:
+            torrent.remove()
+            torrent.cleanup()
+
+
     def __call__(self):
         return self.__init__()
 
     def __repr__(self):
-        return f"Torrentstream listening on {PORTS}"
+        return f"Torrentstream listening on {self.port} ({self.profile})"
+
+    def dispatch(self, alert):
+        """Hand a torrent alert to the `Torrent` it belongs to"""
+        if not isinstance(alert, lt.torrent_alert) or not alert.handle.is_valid():
+            return
+
+        torrent = self.find_torrent(str(alert.handle.info_hash()))
+        if torrent:
+            torrent.on_alert(alert)
+
+    def maintain(self):
+        """Periodically retire idle torrents, save fast-resume data and keep the download cache within its quota"""
+        self.lifecycle.maintain()
+
+        if not self.download_cache:
+            self._downloaded_bytes = sum(torrent.handle.status().total_done for torrent in self
+                                         if torrent.handle is not None)
+            return
+
+        for torrent in self:
+            torrent.save_resume_data(only_if_modified=True)
+
+        self.download_cache.refresh(self.torrents)
+        self.download_cache.evict(keep=set(self.torrents))
 
     @property
-    def alerts(self):
-        if all(a.finished for a in self):
-            raise StopIteration()
-        for alert in self.session.pop_alerts():
-            yield alert
+    def cached_bytes(self):
+        """Bytes of payload on disk, as of the last measurement"""
+        return self.download_cache.size if self.download_cache else self._downloaded_bytes
 
-    def remove_torrent(self, *args, **kwargs):
+    def remove_torrent(self, torrent):
         """Remove torrent from session."""
-        self.session.remove_torrent(*args, **kwargs)
-        del self.torrents[args]
+        with self._lock:
+            self.torrents.pop(torrent.info_hash, None)
+        torrent.remove()
+        torrent.cleanup()
+        self.scheduler.forget(torrent)
 
-    def add_torrent(self, *args, **kwargs):
+    def add_torrent(self, *args, info_hash=None, **kwargs):
         """Add a torrent to this session
 
         For accepted parameters reference, see over `Torrent` definition.
+        Passing an already known `info_hash` avoids parsing the torrent again.
         """
-        torrent = self.find_torrent(*args, **kwargs)
+        if not info_hash:
+            info_hash = str(lt.torrent_info(kwargs.get('torrent_path')).info_hash())
+
+        with self._lock:  # find and append atomically, so a torrent is only added once
+            torrent = self.find_torrent(info_hash)
+
+            if torrent:
+                logging.debug("Reusing: %s", torrent)
+            else:
+                torrent = Torrent(session=self.session, piece_cache=self.piece_cache,
+                                  download_cache=self.download_cache, lifecycle=self.lifecycle,
+                                  metrics=self.metrics, peers=self.peers, scheduler=self.scheduler,
+                                  read_timeout=self.read_timeout, stall_timeout=self.stall_timeout,
+                                  trackers=self.trackers, *args, **kwargs)
+                self.torrents[info_hash] = torrent
+                logging.debug(f"Starting: {torrent}")
 
-        if torrent:
-            logging.debug(f"Reusing: {torrent}")
-        else:
-            torrent = Torrent(session=self.session, *args, **kwargs)
-            self.torrents.append(torrent)
-            logging.debug(f"Starting: {torrent}")
-        
         return torrent
 
-    def find_torrent(self, *args, **kwargs):
-        """ Finds an torrent givee an torrent file
+    def open_file(self, torrent_path, index, meta=None, nonblocking=False):
+        """Start the torrent of torrent_path if needed and open the file at index in it
 
+        Returns a `TorrentFileReader`, whose head and tail are prefetched if
+        it is a media file. A torrent whose payload is found below one of
+        `payload_dirs` is read from there. Raises `ReadTimeout` when the
+        torrent does not start within `read_timeout`.
         """
-        info = lt.torrent_info(kwargs.get('torrent_path'))
+        params = {}
+        if self.payload_dirs:
+            meta = meta or TorrentMeta.from_file(torrent_path)
+            local = not self.find_torrent(meta.info_hash) and find_payload(meta, torrent_path, self.payload_dirs)
+            if local:
+                logging.info(f"Reading {meta} from {local}, downloading what fails verification")
+                params = {'save_path': local, 'local_payload': True}
+
+        with self.add_torrent(torrent_path=torrent_path, info_hash=meta and meta.info_hash,
+                              remove_after=True, **params) as torrent:
+            if not torrent.local_payload:  # only the pieces failing verification are wanted
+                torrent.sequential(True)
+
+            if not torrent.wait_for('started', timeout=self.read_timeout):
+                raise ReadTimeout(f"{torrent} did not start within {self.read_timeout}s")
+
+        reader = torrent.files[index].open(nonblocking)
+        self.prefetcher.prefetch(reader)
+        return reader
+
+    def download_rate(self, info_hash):
+        """Bytes per second info_hash is downloading at, 0 if it is not in the session"""
+        torrent = self.find_torrent(info_hash)
+        return torrent.status.get('download', 0) if torrent else 0
+
+    def release_torrents(self, path):
+        """Remove the torrents of the deleted .torrent file or directory at path, unless files of them are open"""
+        prefix = os.path.join(path, '')
+        for torrent in self:
+            if torrent.torrent_path != path and not torrent.torrent_path.startswith(prefix):
+                continue
+
+            if torrent.readers:  # the lifecycle retires it once the readers are gone
+                logging.info(f"{torrent} was removed, it is still open")
+            else:
+                logging.info(f"{torrent} was removed, detaching it")
+                self.remove_torrent(torrent)
+
+    def have_pieces(self, info_hash):
+        """Whether each piece of info_hash is downloaded, from libtorrent or else its fast-resume data"""
+        torrent = self.find_torrent(info_hash)
+        handle = torrent and torrent.handle
+        if handle is not None:
+            pieces = handle.status(lt.status_flags_t.query_pieces).pieces
+            for piece in torrent.verified:
+                pieces[piece] = True
+            return pieces
+
+        resume = self.download_cache and self.download_cache.load_resume(info_hash)
+        if resume:
+            try:
+                return lt.read_resume_data(resume).have_pieces
+            except RuntimeError:
+                pass
+        return []
+
+    def find_torrent(self, info_hash):
+        """ Finds an torrent given its info hash
 
-        for torrent in self.torrents:
-            if info.info_hash() == torrent.info.info_hash():
-                return torrent
-        return None
+        """
+        with self._lock:
+            return self.torrents.get(info_hash)
 
     def __iter__(self):
         """Iterating trough a session will give you all the currently-downloading torrents"""
-        return iter(self.torrents)
+        with self._lock:
+            return iter(list(self.torrents.values()))
+
+
+class TorrentLifecycle:
+    """Bounds the torrents a session keeps downloading
+
+    At most `max_active` torrents run at once, activating another one pauses
+    the least recently read of them, preferring those without open readers.
+    Torrents a read is waiting on or that were read in the last `BUSY`
+    seconds are never paused for another, so more may run for a while.
+    Torrents not read for `idle_timeout` seconds are paused, and removed from
+    libtorrent after another `idle_timeout`, which closes their peer
+    connections and disk handles. Removed torrents without open readers are
+    forgotten by the session. Reading from a paused or removed torrent
+    activates it again. Torrents libtorrent stopped with an error are resumed
+    every `ERROR_RETRY` seconds while they are being read.
+    """
+    BUSY = 5.0  # seconds after a read a torrent is not paused to activate another
+
+    def __init__(self, session: TorrentSession, max_active=MAX_ACTIVE, idle_timeout=IDLE_TIMEOUT):
+        self.session = session
+        self.max_active = max_active
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+
+    def activate(self, torrent):
+        """Add or resume torrent, pausing others to stay within max_active"""
+        with self._lock:
+            torrent.activate()
+
+            active = [t for t in self.session if t.active and t is not torrent]
+            excess = len(active) + 1 - self.max_active
+            if excess > 0:
+                # pausing a torrent that is being read only has it activated again right away
+                now = time.monotonic()
+                idle = [t for t in active if not t.waiters and now - t.last_read >= self.BUSY]
+                for other in sorted(idle, key=lambda t: (t.readers > 0, t.last_read))[:excess]:
+                    logging.debug(f"Pausing {other}, {self.max_active} torrents are active")
+                    other.pause()
+        return torrent
+
+    def maintain(self):
+        """Pause, remove and forget torrents that have been idle for too long"""
+        now = time.monotonic()
+
+        for torrent in self.session:
+            idle = now - torrent.last_read
+
+            if idle > 2 * self.idle_timeout:
+                if torrent.handle is not None:
+                    logging.debug(f"Removing idle torrent: {torrent}")
+                    torrent.remove()
+                if not torrent.readers:
+                    self.session.remove_torrent(torrent)
+
+            elif idle > self.idle_timeout and torrent.active:
+                logging.debug(f"Pausing idle torrent: {torrent}")
+                torrent.pause()
+
+            elif torrent.error and idle <= self.idle_timeout:
+                torrent.recover()
+
+
+class AlertDispatcher(threading.Thread):
+    """Single thread popping libtorrent alerts and waking up waiters"""
+    def __init__(self, session: TorrentSession, interval=0.5):
+        super().__init__(name='alert-dispatcher', daemon=True)
+        self.session = session
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            if not self.session.session.wait_for_alert(int(self.interval * 1000)):
+                continue
+
+            for alert in self.session.session.pop_alerts():
+                try:
+                    self.session.dispatch(alert)
+                except Exception:
+                    logging.exception(f"Failed to dispatch alert: {alert.message()}")
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
+
+
+class SessionMaintainer(threading.Thread):
+    """Runs `TorrentSession.maintain` every `interval` seconds
+
+    Maintenance walks the download cache and waits on disk, so it has a
+    thread of its own rather than holding up the alerts readers wait for.
+    """
+    def __init__(self, session: TorrentSession, interval=RESUME_INTERVAL):
+        super().__init__(name='session-maintainer', daemon=True)
+        self.session = session
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.session.maintain()
+            except Exception:
+                logging.exception("Failed to maintain torrent session")
+
+    def stop(self):
+        self._stopped.set()
+        if self.is_alive() and self is not threading.current_thread():
+            self.join()
 
 
 class Torrent:
@@ -131,13 +475,34 @@ class Torrent:
                  session: TorrentSession,
                  trackers: tuple = TRACKERS,
                  remove_after: bool = False,
+                 piece_cache=None,
+                 download_cache=None,
+                 lifecycle=None,
+                 metrics=None,
+                 peers=(),
+                 scheduler=None,
+                 read_timeout=READ_TIMEOUT,
+                 stall_timeout=STALL_TIMEOUT,
+                 local_payload=False,
                  **params):
 
         self.session = session
+        self.torrent_path = torrent_path
         self.temp_dir = None
         self.time_added = datetime.now()
         self.remove_after = remove_after
         self.info = lt.torrent_info(torrent_path)
+        self.info_hash = str(self.info.info_hash())
+        self.meta = TorrentMeta.from_info(self.info)  # offsets, sizes and paths of the files
+
+        # save_path holds an existing copy of the payload, only what fails verification is downloaded
+        self.local_payload = local_payload
+        self.default_priority = 0 if local_payload else DEFAULT_PRIORITY  # of pieces nobody asked for
+        # file priorities, applied by update_priorities; libtorrent keeps pieces of priority 0 files in
+        # its part file, so the files of a local payload are wanted and its pieces are not instead
+        self.priorities = array('B', [1 if local_payload else DEFAULT_PRIORITY]) * len(self.meta)
+        self.verified = set()  # pieces of the local payload that passed their hash check
+        self._corrupt = set()  # pieces of the local payload that failed it, or are missing
 
         for tracker in trackers: # insert additional trackers
             self.info.add_tracker(tracker)
@@ -150,24 +515,162 @@ class Torrent:
         }
 
         self.handle = None
+        self.sequential_download = False  # set again when the torrent is added again
+        self._files = None
+        self._snapshots = {}  # name -> (time, values) of batched per-file queries
+        self._lock = threading.RLock()
+        self.error = None
+        self.piece_cache = piece_cache
+        self.download_cache = download_cache
+        self.lifecycle = lifecycle
+        self.metrics = metrics or Metrics()
+        self.peers = peers
+        self.scheduler = scheduler or PieceScheduler()
+        self.read_timeout = read_timeout
+        self.stall_timeout = stall_timeout
+        self._unstalled = 0  # monotonic time peers were last looked for because of a stall
+        self._errored = 0  # monotonic time of the last error, or of the last retry after it
+        self.paused = False
+        self.readers = 0  # open TorrentFileReaders
+        self.waiters = 0  # reads blocked on missing pieces
+        self.last_read = time.monotonic()
+        self._resume = None  # Event set once the requested resume data is saved
+        self._reads = {}  # piece index -> Event set once read_piece returned its data
+        self._pieces = {}  # piece index -> Event set once the piece is downloaded
+        self._progress = threading.Condition(self._lock)
+        self._events = {'started': threading.Event(), 'finished': threading.Event()}
 
     def __enter__(self):
-        if not self.params.get('save_path'):
-            self.temp_dir = tempfile.TemporaryDirectory()
-            self.params['save_path'] = self.temp_dir.name
-
-        self.handle = self.session.add_torrent(self.params)
+        if self.lifecycle:
+            self.lifecycle.activate(self)
+        else:
+            self.activate()
         return self
 
+    def activate(self):
+        """Add the torrent to libtorrent, or resume it if it is paused"""
+        self.recover()
+        self.last_read = time.monotonic()  # or the lifecycle may remove it again before it is read
+
+        with self._lock:  # concurrent readers must not add the torrent twice
+            if self.paused:
+                self.handle.resume()
+                self.paused = False
+
+            added = self.handle is None
+            if added:
+                if not self.params.get('save_path') and self.download_cache:
+                    self.params['save_path'] = self.download_cache.save_path(self.info_hash)
+                elif not self.params.get('save_path'):
+                    self.temp_dir = tempfile.TemporaryDirectory()
+                    self.params['save_path'] = self.temp_dir.name
+
+                self.handle = self.session.add_torrent(self._add_params())
+                self.error = None  # reported for the previous handle
+                for peer in self.peers:
+                    self.handle.connect_peer(peer)
+
+                # a new handle starts from the add parameters, restore what was set on the previous one
+                if self.sequential_download:
+                    self.handle.set_sequential_download(True)
+
+                if self.handle.has_metadata():
+                    self._events['started'].set()
+
+        if added:  # demand set while it was removed did not reach libtorrent
+            self.scheduler.reapply(self)
+
+    def pause(self):
+        """Stop downloading and uploading, keeping the torrent in libtorrent"""
+        with self._lock:
+            if not self.active:
+                return
+            self.handle.unset_flags(lt.torrent_flags.auto_managed)  # or the queue resumes it
+            self.handle.pause()
+            self.paused = True
+
+        self.save_resume_data()  # nothing changes while paused, so it is current on removal
+
+    def remove(self):
+        """Remove the torrent from libtorrent, it is added again when activated"""
+        with self._lock:
+            handle, self.handle = self.handle, None
+            self.paused = False
+
+        if handle is not None:
+            self.session.remove_torrent(handle)
+            self._events['started'].clear()
+            self._wake_all()
+
+    def cleanup(self):
+        """Delete the temporary download directory, if the torrent should not be kept"""
+        for file in self._files or ():
+            file.close()
+
+        with self._lock:
+            if self.temp_dir and self.remove_after:
+                self.temp_dir.cleanup()
+                self.temp_dir = None
+                self.params['save_path'] = None
+
+    @property
+    def active(self):
+        """Whether the torrent is added to libtorrent and not paused, by us or by libtorrent on an error"""
+        return self.handle is not None and not self.paused and not self.error
+
+    def recover(self):
+        """Clear the error libtorrent paused the torrent with and resume it, at most once per ERROR_RETRY"""
+        now = time.monotonic()
+        with self._lock:
+            handle, error = self.handle, self.error
+            if handle is None or not error or now - self._errored < ERROR_RETRY:
+                return
+            self._errored = now
+            self.error = None  # reported again by an alert if it persists
+
+        logging.info(f"{self}: resuming after error: {error}")
+        self.metrics.add('error_retries')
+        handle.clear_error()
+        if not self.paused:  # or `activate` resumes it, within max_active
+            handle.resume()
+
     def __exit__(self, *args, **kwargs):
         pass
 
+    def _add_params(self):
+        """Return the add parameters, with fast-resume data from the download cache if any"""
+        resume = self.download_cache and self.download_cache.load_resume(self.info_hash)
+        params = None
+        if resume:
+            try:
+                params = lt.read_resume_data(resume)
+            except RuntimeError as e:
+                logging.warning(f"{self}: ignoring broken resume data: {e}")
+
+        if params is None and not self.local_payload:
+            return dict(self.params, file_priorities=self.priorities.tolist())
+        if params is None:
+            # claiming no pieces, rather than having no resume data, keeps libtorrent
+            # from checking the whole payload up front, it is verified as it is read
+            params = lt.add_torrent_params()
+            params.have_pieces = [False] * self.meta.num_pieces
+
+        params.ti = self.info
+        params.save_path = self.params['save_path']
+        params.storage_mode = self.params['storage_mode']
+        params.file_priorities = self.priorities.tolist()
+        if self.local_payload:  # nothing is wanted until a read finds a piece missing or corrupt
+            params.piece_priorities = [self.default_priority] * self.meta.num_pieces
+        return params
+
     def __repr__(self):
         return self.info.name()
 
     def sequential(self, value: bool):
         """Set sequential download"""
-        self.handle.set_sequential_download(value)
+        with self._lock:
+            self.sequential_download = value
+            self.handle.set_sequential_download(value)
 
     @property
     def queue(self):
@@ -191,18 +694,17 @@ class Torrent:
     @property
     def name(self):
         """ Torrent name """
-        if not self.handle.status.has_metadata():
-            return "N/A"
-        return self.torrent_info.name()
+        return self.info.name()
 
     @property
     def status(self):
         """
             Return a status dict.
         """
-        if not hasattr(self, 'handle'):
-            return
-        status = self.handle.status()
+        handle = self.handle
+        if handle is None:
+            return {'name': self.name, 'state': 'removed'}
+        status = handle.status()
         result = {
             'name': self.name,
             'download': status.download_rate,
@@ -211,7 +713,9 @@ class Torrent:
             'total_upload': status.total_upload
         }
 
-        if not self.finished:
+        if self.paused:
+            result['state'] = 'paused'
+        elif not status.is_finished:
             result.update({
                 'state': STATUSES[status.state],
                 'total_downloaded': status.total_done,
@@ -237,26 +741,55 @@ class Torrent:
         """Return handle.torrent_info"""
         return self.handle.get_torrent_info()
 
-    @cached_property
+    @property
     def files(self):
         """Returns a `TorrentFile` object for each file"""
-        fnum = range(len(self.torrent_info.files()))
-        return [TorrentFile(self, i) for i in fnum]
+        with self._lock:
+            if self._files is None:
+                self._files = [TorrentFile(self, i) for i in range(len(self.meta))]
+            return self._files
 
     def update_priorities(self):
-        """Update file priorities with self.files."""
-        self.handle.prioritize_files([a.priority for a in self.files])
+        """Apply self.priorities to libtorrent"""
+        with self._lock:
+            if self.handle is not None:
+                self.handle.prioritize_files(self.priorities.tolist())
+            self._snapshots.pop('priorities', None)
 
     def download_only(self, file):
         """ Filter out priorities for every file except this one"""
-        if file not in self.files:
-            return None
-        for file_ in self.files:
-            file.priority = 7 if file == file_ else 0
-        return file
+        with self._lock:
+            if file.torrent is not self:
+                return None
+            self.priorities = array('B', [0]) * len(self.meta)
+            self.priorities[file.index] = 7
+            self.update_priorities()
+            return file
 
-    def wait_for(self, status):
-        """Wait for a specific status
+    def file_progress(self):
+        """Bytes downloaded of every file, fetched at most once per SNAPSHOT_TTL"""
+        return self._snapshot('progress', lambda handle: handle.file_progress(
+            flags=lt.torrent_handle.piece_granularity))
+
+    def file_priorities(self):
+        """libtorrent's priority of every file, fetched at most once per SNAPSHOT_TTL"""
+        return self._snapshot('priorities', lambda handle: handle.get_file_priorities())
+
+    def _snapshot(self, name, fetch):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._snapshots.get(name)
+            handle = self.handle
+            if entry and (now - entry[0] < SNAPSHOT_TTL or handle is None):
+                return entry[1]
+
+        values = fetch(handle) if handle is not None else [0] * len(self.meta)
+        with self._lock:
+            self._snapshots[name] = (now, values)
+        return values
+
+    def wait_for(self, status, timeout=None):
+        """Wait for a specific status, returns False if timeout seconds passed first
 
         Example:
             >>> # This will wait for a torrent to start, and return the torrent
@@ -265,8 +798,286 @@ class Torrent:
             >>> # This will wait for a torrent to finish, and return the torrent
             >>> torrent = await Torrent("magnet:...").wait_for('finished')
         """
+        event = self._events.get(status)
+        deadline = time.monotonic() + timeout if timeout else None
+
         while not getattr(self, status):
-            time.sleep(1)
+            if deadline and time.monotonic() >= deadline:
+                return False
+            if event:
+                event.wait(1)
+            else:
+                time.sleep(1)
+        return True
+
+    def wait_for_pieces(self, pieces):
+        """Block until every piece in pieces is downloaded
+
+        Raises `ReadTimeout` once `read_timeout` passed, and `TorrentError`
+        right away when pieces are missing while libtorrent reports an error
+        for the torrent, until it is resumed or added again. When the
+        pieces make no progress for `stall_timeout`, peers are looked for again.
+        """
+        # downloaded and verified pieces stay readable when libtorrent fails on the others
+        missing = [p for p in pieces if not self.have_piece(p)]
+        if not missing:
+            return
+        if self.error:
+            raise TorrentError(self.error)
+
+        start = time.perf_counter()
+        with self._lock:
+            self.waiters += 1
+        try:
+            self._wait_for_missing(missing)
+        except ReadTimeout:
+            self.metrics.add('read_timeouts')
+            raise
+        finally:
+            with self._lock:
+                self.waiters -= 1
+            self.metrics.observe('piece_wait', time.perf_counter() - start)
+            self.metrics.add('pieces_waited', len(missing))
+
+    def _wait_for_missing(self, missing):
+        now = time.monotonic()
+        deadline = now + self.read_timeout if self.read_timeout else None
+        progress, progressed = self._progress_of(missing), now
+
+        for piece in missing:
+            while True:
+                if not self.active:  # paused or removed by the lifecycle while waiting
+                    self.touch()
+
+                event = self.piece_event(piece)
+
+                # check after registering, the alert may have been dispatched already
+                if self.handle.have_piece(piece):
+                    break
+                if self.error:
+                    raise TorrentError(self.error)
+
+                now = time.monotonic()
+                if deadline and now >= deadline:
+                    raise ReadTimeout(f"{self}: piece {piece} was not downloaded within {self.read_timeout}s")
+
+                if self.stall_timeout and now - progressed >= self.stall_timeout:
+                    current = self._progress_of(missing)
+                    if current == progress:
+                        self._unstall(piece)
+                    progress, progressed = current, now
+
+                event.wait(min(1, deadline - now) if deadline else 1)
+
+    def _progress_of(self, pieces):
+        """Downloaded pieces and bytes of the partial ones among pieces, to tell whether they advance"""
+        handle = self.handle
+        if handle is None:
+            return None
+
+        wanted = set(pieces)
+        partial = sum(block['bytes_progress'] for entry in handle.get_download_queue()
+                      if entry['piece_index'] in wanted for block in entry['blocks'])
+        return sum(1 for p in pieces if handle.have_piece(p)), partial
+
+    def _unstall(self, piece):
+        """Announce to trackers and the DHT again and reconnect the known peers, at most once per stall_timeout"""
+        now = time.monotonic()
+        with self._lock:
+            handle = self.handle
+            if handle is None or now - self._unstalled < self.stall_timeout:
+                return
+            self._unstalled = now
+
+        logging.warning(f"{self}: no progress on piece {piece} for {self.stall_timeout}s, looking for peers")
+        self.metrics.add('stalls')
+        handle.force_reannounce()
+        handle.force_dht_announce()
+        for peer in self.peers:
+            handle.connect_peer(peer)
+
+    def have_piece(self, piece):
+        """Whether piece can be read, hashing it first if it is part of an unverified local payload"""
+        if self.handle.have_piece(piece) or piece in self.verified:
+            return True
+        if not self.local_payload or piece in self._corrupt:
+            return False
+
+        data = self._read_local(piece)
+        try:
+            expected = self.info.hash_for_piece(piece)
+        except RuntimeError:  # v2-only torrents have no piece hashes to check against
+            expected = None
+
+        with self._lock:
+            if data is not None and expected and hashlib.sha1(data).digest() == expected:
+                self.verified.add(piece)
+                self.metrics.add('pieces_verified')
+                return True
+
+            self._corrupt.add(piece)
+            self.metrics.add('pieces_verify_failed')
+            return False
+
+    def needs_download(self, piece):
+        """Whether piece has to come from the swarm, without hashing anything"""
+        if self.handle.have_piece(piece) or piece in self.verified:
+            return False
+        return not self.local_payload or piece in self._corrupt
+
+    def _read_local(self, piece):
+        """Read piece from the payload files below save_path, None if they are missing or short"""
+        meta = self.meta
+        start = piece * meta.piece_length
+        end = min(start + meta.piece_length, meta.offsets[-1] + meta.sizes[-1])
+        chunks = []
+
+        files = self.info.files()
+        index = bisect_right(meta.offsets, start) - 1
+        while start < end and index < len(meta):
+            offset, size = meta.offsets[index], meta.sizes[index]
+            length = min(end, offset + size) - start
+            if length > 0 and files.pad_file_at(index):  # BEP 47 padding is zeros that are never on disk
+                chunks.append(bytes(length))
+                start += length
+            elif length > 0:
+                try:
+                    with open(os.path.join(self.params['save_path'], meta.paths[index]), 'rb') as file:
+                        data = os.pread(file.fileno(), length, start - offset)
+                except OSError:
+                    return None
+                if len(data) < length:
+                    return None
+                chunks.append(data)
+                start += length
+            index += 1
+
+        return b''.join(chunks)
+
+    def piece_event(self, piece):
+        """Return an Event set once piece is downloaded, check have_piece after getting it"""
+        with self._lock:
+            return self._pieces.setdefault(piece, threading.Event())
+
+    def touch(self):
+        """Record a read, activating the torrent again if it was paused or removed"""
+        self.last_read = time.monotonic()
+        if not self.active:
+            self.__enter__()
+        if self.download_cache:
+            self.download_cache.touch(self.info_hash)
+
+    def save_resume_data(self, only_if_modified=False):
+        """Ask libtorrent for fast-resume data, returns an Event set once it is saved
+
+        Returns None if there is nothing to save.
+        """
+        if not self.download_cache or self.handle is None or not self.handle.is_valid():
+            return None
+        if only_if_modified and not self.handle.need_save_resume_data():
+            return None
+
+        with self._lock:
+            if self._resume is None:
+                self._resume = threading.Event()
+                self.handle.save_resume_data(lt.save_resume_flags_t.flush_disk_cache |
+                                             lt.save_resume_flags_t.save_info_dict)
+            return self._resume
+
+    def on_alert(self, alert):
+        """Called from the `AlertDispatcher` for alerts about this torrent"""
+        if isinstance(alert, lt.piece_finished_alert):
+            with self._lock:
+                event = self._pieces.pop(alert.piece_index, None)
+                self._progress.notify_all()
+            if event:
+                if self.piece_cache:  # someone is waiting for it, start reading it right away
+                    self._read_piece(alert.piece_index)
+                event.set()
+
+        elif isinstance(alert, lt.read_piece_alert):
+            with self._lock:
+                event = self._reads.pop(alert.piece, None)
+            if event:
+                event.data = None if alert.error.value() else alert.buffer
+                if event.data is not None:
+                    self.piece_cache.put((self.info_hash, alert.piece), event.data)
+                event.set()
+
+        elif isinstance(alert, (lt.save_resume_data_alert, lt.save_resume_data_failed_alert)):
+            if isinstance(alert, lt.save_resume_data_alert):
+                self.download_cache.store_resume(self.info_hash, lt.write_resume_data_buf(alert.params))
+            else:
+                logging.warning(f"{self}: {alert.message()}")
+
+            with self._lock:
+                event, self._resume = self._resume, None
+            if event:
+                event.set()
+
+        elif isinstance(alert, (lt.metadata_received_alert, lt.add_torrent_alert)):
+            self._events['started'].set()
+
+        elif isinstance(alert, lt.torrent_finished_alert):
+            self._events['finished'].set()
+            self._wake_all()
+
+        elif isinstance(alert, (lt.torrent_error_alert, lt.file_error_alert)):
+            logging.warning(f"{self}: {alert.message()}")
+            with self._lock:
+                self.error = alert.message()
+                self._errored = time.monotonic()
+            self._wake_all()
+
+        elif isinstance(alert, lt.torrent_resumed_alert):
+            self.error = None  # libtorrent pauses a torrent on errors, resuming it retries
+
+    def read_cached(self, offset, length):
+        """Read length bytes at the torrent offset through the piece cache"""
+        piece_length = self.meta.piece_length
+        first, last = offset // piece_length, (offset + length - 1) // piece_length
+        chunks = []
+
+        for p in range(first, last + 1):
+            view = memoryview(self.piece_data(p))
+            start = offset - p * piece_length if p == first else 0
+            end = offset + length - p * piece_length if p == last else len(view)
+            chunks.append(view[start:end])
+
+        return chunks[0].tobytes() if len(chunks) == 1 else b''.join(chunks)
+
+    def piece_data(self, piece):
+        """Return the data of a downloaded piece, from memory if it is cached"""
+        data = self.piece_cache.get((self.info_hash, piece))
+        if data is not None:
+            self.metrics.add('piece_cache_hits')
+            return data
+
+        self.metrics.add('piece_cache_misses')
+        event = self._read_piece(piece)
+        deadline = time.monotonic() + self.read_timeout if self.read_timeout else None
+        while not event.wait(1):  # a failed read is reported by its read_piece_alert
+            if deadline and time.monotonic() >= deadline:
+                raise ReadTimeout(f"{self}: reading piece {piece} took over {self.read_timeout}s")
+
+        if event.data is None:
+            raise TorrentError(f"Failed to read piece {piece}")
+        return event.data
+
+    def _read_piece(self, piece):
+        with self._lock:
+            event = self._reads.get(piece)
+            if event is None:
+                event = self._reads[piece] = threading.Event()
+                self.handle.read_piece(piece)
+        return event
+
+    def _wake_all(self):
+        with self._lock:
+            events, self._pieces = self._pieces, {}
+            self._progress.notify_all()
+        for event in events.values():
+            event.set()
 
     def __iter__(self):
         """Iterating trough a Torrent instance will return each TorrentFile"""
@@ -276,113 +1087,842 @@ class Torrent:
 class TorrentFile:
     """ Wrapper over libtorrent.file """
     def __init__(self, parent: Torrent, index: int):
-        self.root = parent.params.get('save_path')
         self.index = index
-        self.handle = parent.handle
         self.torrent = parent
+        self.path = parent.meta.paths[index]
+        self.size = parent.meta.sizes[index]
+        self.offset = parent.meta.offsets[index]
+        self._fd = None  # payload file used by `read`, readers keep their own
 
     def __repr__(self):
         return str(self.path)
 
-    def wait_for_completion(self, percent):
-        while self.completed_percent < percent:
-            time.sleep(5)
+    @property
+    def handle(self):
+        """Current libtorrent handle, it changes when the torrent is added again"""
+        return self.torrent.handle
 
-    @cached_property
-    def path(self):
-        """Return torrent path on filesystem"""
-        return self.hfile.path
+    @property
+    def root(self):
+        return self.torrent.params.get('save_path')
+
+    def wait_for_completion(self, percent):
+        with self.torrent._progress:
+            while self.completed_percent < percent:
+                self.torrent._progress.wait(5)
 
     @cached_property
     def file(self):
         """Return a file object with this file's path open in rb mode """
         return open(self.path, 'rb')
 
+    def open(self, nonblocking=False):
+        """Return a `TorrentFileReader` keeping the payload file open"""
+        with self.torrent._lock:
+            self.torrent.readers += 1
+        return TorrentFileReader(self, nonblocking)
+
     def read(self, length, offset):
-        # TODO: while this works okayish
-        # we have issues with buffering
-        # especially on larger files
-        # so we need some form of readahead
+        self.torrent.touch()
+        if self.fetch(length, offset):
+            self.handle.flush_cache()
 
-        # TODO: can we find inspiration here?
-        # https://github.com/animeshkundu/pyflix/blob/master/torrent/strategy.py
+        with self.torrent._lock:
+            if self._fd is None:
+                self._fd = os.open(os.path.join(self.root, self.path), os.O_RDONLY)
+            fd = self._fd
+        return os.pread(fd, length, offset)
+
+    def close(self):
+        """Close the payload file kept open by `read`"""
+        with self.torrent._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def fetch(self, length, offset, readahead=None, block=True):
+        """Block until the pieces backing length bytes at offset are downloaded
+
+        Without a `Readahead` only the needed pieces are demanded, as an
+        interactive reader. Returns True if it had to wait for pieces to be
+        downloaded. When block is False, BlockingIOError is raised instead
+        of waiting, the readahead keeps the pieces scheduled.
+        """
         offset += self.offset
-        info = self.handle.get_torrent_info()
-        piece_length = info.piece_length()
+        piece_length = self.torrent.meta.piece_length
 
-        logging.debug(f"{info.name()} - length: {length} | offset: {offset} | piece length: {piece_length}")
+        needed_pieces = range(offset // piece_length, (offset + max(length, 1) - 1) // piece_length + 1)
 
-        needed_pieces = range(offset // piece_length, (offset + length) // piece_length + 1)
-        completed_pieces = all(self.handle.have_piece(p) for p in needed_pieces)
-        #prioritized_pieces = []
+        if readahead:
+            readahead.update(offset, length)
+            readahead.schedule(needed_pieces, urgent=block)
 
-        if not completed_pieces:  # We don't have the needed pieces
-            logging.debug(f"Asking for pieces: {needed_pieces}")
+        if all(self.torrent.have_piece(p) for p in needed_pieces):
+            return False
 
-            # https://www.libtorrent.org/streaming.html
-            deadline = 10000
+        if not block and readahead:
+            raise BlockingIOError(errno.EAGAIN, f"{self}: piece {needed_pieces[0]} is not downloaded yet")
 
-            for p in range(needed_pieces[-1], min(needed_pieces[-1] + 4, info.num_pieces())):
-                logging.debug(f"Setting deadline for piece: {p}")
-                #self.handle.piece_priority(p, 7)
-                self.handle.piece_priority(p, 7)
-                self.handle.set_piece_deadline(p, deadline)
-                deadline -= 1000
+        if not readahead:  # We don't have the needed pieces
+            demand = {p: 0 for p in needed_pieces if self.torrent.needs_download(p)}
+            self.torrent.scheduler.update(self, self.torrent, demand, INTERACTIVE)
 
-            completed_pieces = False
-
-            logging.debug(f"Waiting to complete pieces: {needed_pieces}")
-            while not completed_pieces:
-                completed_pieces = all(self.handle.have_piece(p) for p in needed_pieces)
-                time.sleep(0.1)
-            
-            self.handle.flush_cache()
-        else:
-            logging.debug(f"Pieces already downloaded: {needed_pieces}")
-   
-        with open(os.path.join(self.root, self.path), 'rb') as file:
-            file.seek(offset - self.offset)
-            return file.read(length)
+        logging.debug("Waiting to complete pieces: %s", needed_pieces)
+        try:
+            self.torrent.wait_for_pieces(needed_pieces)
+        finally:
+            if not readahead:
+                self.torrent.scheduler.release(self)
+        return True
 
     @property
     def filehash(self):
         """File hash"""
-        return self.hfile.filehash
-
-    @property
-    def size(self):
-        """File size"""
-        return self.hfile.size
-
-    @property
-    def offset(self):
-        """File offset"""
-        return self.hfile.offset
-
-    @property
-    @get_indexed
-    def hfile(self):
-        """ Return file from libtorrent """
-        return self.handle.get_torrent_info().files
+        return self.torrent.info.files().hash(self.index)
 
     @property
-    @get_indexed
     def priority(self):
-        """ Readonly file priority from libtorrent """
-        return self.handle.file_priorities
+        """ File priority from libtorrent """
+        return self.torrent.file_priorities()[self.index]
 
     @priority.setter
     def priority(self, value):
-        self._priority = value
+        self.torrent.priorities[self.index] = value
         self.torrent.update_priorities()
 
     @property
-    @get_indexed
     def file_progress(self):
         """ Returns file progress """
-        return self.handle.file_progress
+        return self.torrent.file_progress()[self.index]
 
     @property
     def completed_percent(self):
         """ Returns this file completed percentage """
-        return (self.file_progress / self.size) * 100
+        return (self.file_progress / self.size) * 100 if self.size else 100.0
+
+
+class PieceCache:
+    """ Byte bounded LRU of verified piece data, shared by every torrent """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pieces = OrderedDict()  # (info hash, piece index) -> bytes
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PieceCache({len(self._pieces)} pieces, {self.size}/{self.max_bytes} bytes)"
+
+    def get(self, key):
+        with self._lock:
+            data = self._pieces.get(key)
+            if data is not None:
+                self._pieces.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._pieces.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+
+            self._pieces[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._pieces.popitem(last=False)
+                self.size -= len(evicted)
+
+
+class DownloadCache:
+    """ Payload directories laid out by info hash, kept across remounts
+
+    Each torrent downloads into `<root>/<info hash>/` and keeps its fast-resume
+    data in `<root>/<info hash>.resume`, so pieces downloaded before a remount
+    are neither downloaded nor checked again. With `max_bytes` set, the least
+    recently read torrents are deleted once the payloads outgrow it.
+
+    The disk usage of each payload is measured once in the background when
+    the cache is opened, and afterwards only for the torrents `refresh` is
+    called with, so `size` is known without walking the whole cache.
+    Until the first measurement is done `size` only counts what was measured.
+    """
+    RESUME_EXT = '.resume'
+    TOUCH_INTERVAL = 60  # seconds between updates of a torrent's last read time on disk
+
+    def __init__(self, root, max_bytes=0):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self._last_read = {}  # info hash -> wall clock time of the last read
+        self._sizes = {}  # info hash -> bytes allocated by its payload when last measured
+        self.size = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.root, exist_ok=True)
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.is_dir():  # the directory mtime survives remounts
+                    self._last_read[entry.name] = entry.stat().st_mtime
+        threading.Thread(target=self.refresh, args=(list(self._last_read),), name='download-cache-scan',
+                         daemon=True).start()
+
+    def __repr__(self):
+        return f"DownloadCache({self.root}, {len(self._last_read)} torrents, max {self.max_bytes} bytes)"
+
+    def save_path(self, info_hash):
+        """Return the directory to download info_hash to"""
+        with self._lock:
+            self._last_read.setdefault(info_hash, time.time())
+        return os.path.join(self.root, info_hash)
+
+    def load_resume(self, info_hash):
+        try:
+            with open(self._resume_path(info_hash), 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def store_resume(self, info_hash, data):
+        path = self._resume_path(info_hash)
+        with open(path + '.tmp', 'wb') as file:
+            file.write(data)
+        os.replace(path + '.tmp', path)
+
+    def touch(self, info_hash):
+        """Mark info_hash as read now"""
+        now = time.time()
+
+        with self._lock:
+            if now - self._last_read.get(info_hash, 0) < self.TOUCH_INTERVAL:
+                return
+            self._last_read[info_hash] = now
+
+        try:
+            os.utime(os.path.join(self.root, info_hash), (now, now))
+        except OSError:
+            pass
+
+    def usage(self, info_hash):
+        """Bytes allocated on disk by the payload of info_hash"""
+        total = 0
+        for directory, _, files in os.walk(os.path.join(self.root, info_hash)):
+            for name in files:
+                try:
+                    total += os.lstat(os.path.join(directory, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def refresh(self, info_hashes):
+        """Measure the payloads of info_hashes again and update `size`"""
+        sizes = {info_hash: self.usage(info_hash) for info_hash in list(info_hashes)}
+
+        with self._lock:
+            self._sizes.update(sizes)
+            self.size = sum(self._sizes.values())
+
+    def evict(self, keep=()):
+        """Delete the least recently read torrents, except those in keep, until the cache fits"""
+        if not self.max_bytes:
+            return
+
+        with self._lock:
+            candidates = sorted(self._last_read, key=self._last_read.get)
+            sizes = {info_hash: self._sizes.get(info_hash, 0) for info_hash in candidates}
+        total = sum(sizes.values())
+
+        for info_hash in candidates:
+            if total <= self.max_bytes:
+                break
+            if info_hash in keep:
+                continue
+
+            logging.info(f"Evicting {info_hash} ({sizes[info_hash]} bytes) from the download cache")
+            shutil.rmtree(os.path.join(self.root, info_hash), ignore_errors=True)
+            try:
+                os.remove(self._resume_path(info_hash))
+            except FileNotFoundError:
+                pass
+
+            with self._lock:
+                self._last_read.pop(info_hash, None)
+                self.size -= self._sizes.pop(info_hash, 0)
+            total -= sizes[info_hash]
+
+        if total > self.max_bytes:
+            logging.warning(f"Download cache holds {total} bytes, active torrents exceed {self.max_bytes}")
+
+    def _resume_path(self, info_hash):
+        return os.path.join(self.root, info_hash + self.RESUME_EXT)
+
+
+class TorrentFileReader:
+    """ Read state of a single open TorrentFile
+
+    The payload file stays open for the lifetime of the reader. Sequential
+    readers read up to `READ_BLOCK` bytes of downloaded data at once into a
+    reused buffer, and the adjacent requests the kernel splits a stream
+    into are served from that buffer without touching the file again.
+
+    Non-blocking readers get BlockingIOError right away when any piece of a
+    read is missing, which is scheduled like any other read. They never get
+    a short read: without direct_io the kernel takes one for the end of the
+    file and zero-fills the rest of the page shared with other readers.
+    """
+    def __init__(self, file: TorrentFile, nonblocking=False):
+        self.file = file
+        self.nonblocking = nonblocking
+        self.size = file.size
+        self.path = os.path.join(file.root, file.path)
+        self.position = 0
+        self.fd = None
+        self.readahead = Readahead(file.torrent)
+        self._buffer = None  # allocated once the reader turns out to be sequential
+        self._buffered = (0, 0)  # (file offset, length) of the data in _buffer
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"{self.file} @ {self.position}"
+
+    @property
+    def closed(self):
+        return self._closed
+
+    @property
+    def cached(self):
+        """Whether reads are served from the piece cache rather than the payload file"""
+        torrent = self.file.torrent
+        return bool(torrent.piece_cache) and not torrent.local_payload  # local payloads are on disk anyway
+
+    def wait(self, length, offset):
+        """Wait until the data of a read is downloaded
+
+        Returns how many of the length bytes at offset can be read, and
+        whether pieces had to be downloaded for them.
+        """
+        length = max(0, min(length, self.size - offset))
+        if not length:
+            return 0, False
+
+        self.file.torrent.touch()
+        downloaded = self.file.fetch(length, offset, self.readahead, block=not self.nonblocking)
+
+        if downloaded and not self.cached:
+            self.file.handle.flush_cache()
+        return length, downloaded
+
+    def fileno(self):
+        """The payload file, opened on first use since the sparse file only exists once data arrives"""
+        with self._lock:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_RDONLY)
+            return self.fd
+
+    def read(self, length, offset):
+        length, downloaded = self.wait(length, offset)
+        if not length:
+            return b''
+
+        torrent = self.file.torrent
+        if self.cached:
+            data = torrent.read_cached(self.file.offset + offset, length)
+            torrent.metrics.add('bytes_downloaded' if downloaded else 'bytes_cache', len(data))
+            self.position = offset + len(data)
+            return data
+
+        with self._lock:
+            if self.fd is None:  # the sparse payload file only exists once data arrives
+                self.fd = os.open(self.path, os.O_RDONLY)
+
+            start, count = self._buffered
+            if start <= offset and offset + length <= start + count:
+                torrent.metrics.add('reads_coalesced')
+            elif length < READ_BLOCK and self.readahead.sequential:
+                if self._buffer is None:
+                    self._buffer = bytearray(READ_BLOCK)
+                view = memoryview(self._buffer)[:self._extent(offset, length)]
+                start, count = offset, os.preadv(self.fd, [view], offset)
+                self._buffered = (start, count)
+            else:
+                start = None
+
+            if start is None:
+                data = os.pread(self.fd, length, offset)
+            else:
+                data = bytes(memoryview(self._buffer)[offset - start:min(offset + length, start + count) - start])
+
+        torrent.metrics.add('bytes_downloaded' if downloaded else 'bytes_disk', len(data))
+        self.position = offset + len(data)
+        return data
+
+    def _extent(self, offset, length):
+        """Bytes to read at offset, up to READ_BLOCK as long as the pieces are downloaded"""
+        torrent = self.file.torrent
+        piece_length = torrent.meta.piece_length
+        start = self.file.offset + offset
+        end = start + min(READ_BLOCK, self.size - offset)
+
+        piece = (start + length - 1) // piece_length + 1  # the first piece past the requested data
+        while piece * piece_length < end:
+            if not torrent.have_piece(piece):
+                end = piece * piece_length
+                break
+            piece += 1
+
+        return max(length, end - start)
+
+    def close(self):
+        self.readahead.reset()
+
+        with self._lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+            self._buffer, self._buffered = None, (0, 0)
+            closed, self._closed = self._closed, True
+
+        if not closed:
+            with self.file.torrent._lock:
+                self.file.torrent.readers -= 1
+
+
+class Readahead:
+    """ Streaming readahead for a single reader
+
+    Sequential readers get a window of pieces ahead of the read position,
+    sized to cover `horizon` seconds at the observed consumption rate, with
+    deadlines spread by when the reader is expected to reach each piece.
+    When the reader jumps elsewhere, the deadlines and priorities of the
+    previous window are released so they stop competing with the new position.
+    The window is handed to the torrent's `PieceScheduler` as the demand of
+    this reader, in the `priority_class` it is given, or else interactive
+    for sequential readers and background for the others.
+
+    https://www.libtorrent.org/streaming.html
+    """
+    MIN_WINDOW = 2
+    MAX_WINDOW_BYTES = 256 * 1024 * 1024
+    DEADLINE_STEP = 1000  # ms between pieces until a rate is known
+
+    def __init__(self, torrent: Torrent, horizon=10.0, priority_class=None):
+        self.torrent = torrent
+        self.piece_length = torrent.meta.piece_length
+        self.num_pieces = torrent.meta.num_pieces
+        self.max_window = max(self.MIN_WINDOW, self.MAX_WINDOW_BYTES // self.piece_length)
+        self.horizon = horizon
+        self.priority_class = priority_class
+        self.sequential = False
+        self.rate = 0.0  # bytes per second
+        self.position = None
+        self._scheduled_for = None  # (class, handle) the demand was handed to the scheduler for
+        self._pieces = {}  # piece -> deadline of the pieces in the window that needed downloading when checked
+        self._urgent = set()  # pieces already handed to the scheduler as urgent
+        self._first = 0  # first piece of the window
+        self._until = 0  # end of the pieces already checked
+        self._run_start = None  # (time, offset) of the current sequential run
+        self._lock = threading.Lock()
+
+    @property
+    def handle(self):
+        return self.torrent.handle
+
+    def __repr__(self):
+        return f"Readahead(sequential={self.sequential}, rate={self.rate:.0f}, window={self.window})"
+
+    @property
+    def window(self):
+        """Number of pieces to keep scheduled past the read position"""
+        if not self.sequential:
+            return 1
+        if not self.rate:
+            return self.MIN_WINDOW
+        pieces = -(-int(self.rate * self.horizon) // self.piece_length)
+        return max(self.MIN_WINDOW, min(pieces, self.max_window))
+
+    @property
+    def effective_class(self):
+        if self.priority_class:
+            return self.priority_class
+        return INTERACTIVE if self.sequential else BACKGROUND
+
+    def update(self, offset, length):
+        """Record a read of length bytes at the torrent offset"""
+        now = time.monotonic()
+
+        with self._lock:
+            if self.position is not None and abs(offset - self.position) <= self.piece_length:
+                self.sequential = True
+                start_time, start_offset = self._run_start
+                if now - start_time >= 1.0:
+                    self.rate = (offset + length - start_offset) / (now - start_time)
+            else:
+                if self.position is not None:
+                    logging.debug("Reader jumped from %s to %s", self.position, offset)
+                    self._reset()
+                self.sequential = False
+                self.rate = 0.0
+                self._run_start = (now, offset)
+
+            self.position = offset + length
+
+    def schedule(self, needed_pieces, urgent=False):
+        """Demand needed_pieces and the window after them from the scheduler
+
+        When urgent, a read blocks on needed_pieces, so they come first
+        whatever the priority class, which then only applies to the window.
+        Only pieces new to the window are checked and handed to the scheduler,
+        along with the pieces the reader moved past.
+        """
+        with self._lock:
+            first, last = needed_pieces[0], needed_pieces[-1]
+            end = min(last + 1 + self.window, self.num_pieces)
+            priority_class = self.effective_class
+
+            # the handle changes when the torrent is added again, which needs the demand set again
+            if self._scheduled_for != (priority_class, self.handle) or first < self._first:
+                self._reset()
+                self._scheduled_for = (priority_class, self.handle)
+                self._until = first
+            self._first = first
+
+            released = [p for p in self._pieces if p < first]
+            for piece in released:
+                del self._pieces[piece]
+            self._urgent.difference_update(released)
+
+            demand = {}
+            for piece in range(max(self._until, first), end):
+                if self.torrent.needs_download(piece):
+                    demand[piece] = self._pieces[piece] = self._deadline(piece, piece - first, needed_pieces)
+            self._until = max(self._until, end)
+
+            if urgent:
+                for piece in needed_pieces:
+                    if piece in self._pieces and piece not in self._urgent:
+                        demand[piece] = self._pieces[piece] = 0
+                        self._urgent.add(piece)
+
+            if demand or released:
+                self.torrent.scheduler.extend(self, self.torrent, demand, released, priority_class,
+                                              urgent=self._urgent, origin=first)
+
+    def reset(self):
+        """Drop every deadline and priority set by this reader"""
+        with self._lock:
+            self._reset()
+
+    def _deadline(self, piece, i, needed_pieces):
+        if piece <= needed_pieces[-1]:
+            return 0
+        if self.rate:
+            return max(0, int((piece * self.piece_length - self.position) / self.rate * 1000))
+        return i * self.DEADLINE_STEP
+
+    def _reset(self):
+        self._scheduled_for = None
+        self._pieces.clear()
+        self._urgent.clear()
+        self._until = 0
+        self.torrent.scheduler.release(self)
+
+
+class Prefetcher:
+    """ Prefetch the parts of newly opened files that media probers read first
+
+    Probers read a file's header and then jump to its end for indexes such
+    as MP4 moov atoms or MKV cues. The head and tail given by the file's
+    `PREFETCH_POLICIES` entry are demanded from the scheduler as background
+    work on open, so those jumps find the pieces downloading or done.
+    Prefetches are skipped while `budget` bytes are already outstanding, so
+    a library scan opening many files can not flood the session.
+    """
+    def __init__(self, budget=PROBE_BUDGET, metrics=None, workers=4, timeout=PREFETCH_TIMEOUT):
+        self.budget = budget
+        self.metrics = metrics or Metrics()
+        self.timeout = timeout
+        self.outstanding = 0  # bytes of pieces demanded by running prefetches
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Prefetcher({self.outstanding}/{self.budget} bytes outstanding)"
+
+    @staticmethod
+    def policy(path):
+        """Return the (head, tail) bytes to prefetch of path, None if it has no policy"""
+        mimetype, _ = mimetypes.guess_type(path)
+        if not mimetype:
+            return None
+        return PREFETCH_POLICIES.get(mimetype) or PREFETCH_POLICIES.get(mimetype.split('/')[0])
+
+    def prefetch(self, reader):
+        """Start prefetching for a just opened `TorrentFileReader`, returns a Future or None"""
+        file, torrent = reader.file, reader.file.torrent
+        policy = self.policy(file.path)
+        if not policy or not self.budget or not file.size:
+            return None
+
+        head, tail = policy
+        piece_length = torrent.meta.piece_length
+        ranges = [(file.offset, min(head, file.size)),
+                  (file.offset + max(0, file.size - tail), min(tail, file.size))]
+        pieces = sorted({p for start, length in ranges if length
+                         for p in range(start // piece_length, (start + length - 1) // piece_length + 1)
+                         if torrent.needs_download(p)})
+        if not pieces:
+            return None
+
+        size = len(pieces) * piece_length
+        with self._lock:
+            if self.outstanding + size > self.budget:
+                self.metrics.add('prefetch_skipped')
+                return None
+            self.outstanding += size
+
+        logging.debug("Prefetching pieces %s of %s", pieces, file)
+        self.metrics.add('prefetch_started')
+        key = object()  # the scheduler demand of this prefetch
+        torrent.scheduler.update(key, torrent, {p: 0 for p in pieces}, BACKGROUND)
+        return self._executor.submit(self._wait, reader, key, pieces, size)
+
+    def _wait(self, reader, key, pieces, size):
+        torrent = reader.file.torrent
+        deadline = time.monotonic() + self.timeout
+
+        try:
+            for piece in pieces:
+                while not reader.closed:
+                    event = torrent.piece_event(piece)
+                    handle = torrent.handle
+                    if handle is None or handle.have_piece(piece):
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    event.wait(min(1, remaining))
+        finally:
+            torrent.scheduler.release(key)
+            with self._lock:
+                self.outstanding -= size
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class PieceScheduler:
+    """ Owns every piece priority and deadline set on behalf of readers
+
+    Readers hand in their demand, the pieces they want with a deadline in ms,
+    and each piece gets the highest priority and earliest deadline any
+    reader asked for. Pieces nobody wants anymore are reset to the
+    torrent's default priority. Pieces a read is blocked on come first,
+    whatever the class of their reader. Otherwise interactive readers
+    (playback) come before background readers (probes and scanners), whose
+    pieces get a lower priority and no deadline, as libtorrent raises any
+    piece with a deadline to the top priority. The readahead of
+    interactive readers is spread over their share of the session's download
+    rate, so one stream asking for early deadlines can not take the
+    bandwidth of the others.
+    """
+    PRIORITIES = {INTERACTIVE: 7, BACKGROUND: 6}
+    MIN_RATE = 1024 * 1024  # bytes per second assumed until a download rate is known
+    TOLERANCE = 1000  # ms a deadline has to move forward before it is set again
+    RATE_TTL = 1.0
+
+    def __init__(self, session=None):
+        self.session = session  # TorrentSession, for the download rate
+        self._demand = {}  # (torrent, piece) -> {reader: (deadline, priority)}
+        self._readers = {}  # reader -> (torrent, priority class, set of pieces)
+        self._applied = {}  # (torrent, piece) -> (deadline or None, priority, handle) last set in libtorrent
+        self._rate = (0, 0.0)  # (time measured, bytes per second)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"PieceScheduler({len(self._readers)} readers, {len(self._demand)} pieces)"
+
+    def update(self, reader, torrent, demand, priority_class=INTERACTIVE, urgent=()):
+        """Replace the demand of reader, a dict of piece -> deadline in ms from now
+
+        The pieces in urgent are waited for by a read, they get the interactive
+        priority and a deadline of now in any class.
+        """
+        with self._lock:
+            _, _, previous = self._readers.get(reader, (None, None, set()))
+            released = [p for p in previous if p not in demand]
+            self._change(reader, torrent, demand, released, priority_class, urgent, min(demand, default=0))
+
+    def extend(self, reader, torrent, demand, released, priority_class=INTERACTIVE, urgent=(), origin=0):
+        """Add demand to the demand of reader and drop the pieces in released
+
+        The readahead of interactive readers is paced from the piece origin.
+        """
+        with self._lock:
+            self._change(reader, torrent, demand, released, priority_class, urgent, origin)
+
+    def _change(self, reader, torrent, demand, released, priority_class, urgent, origin):
+        now = time.monotonic() * 1000
+        _, _, pieces = self._readers.get(reader, (None, None, set()))
+
+        if priority_class == INTERACTIVE:
+            share = self._download_rate() / max(1, self._count(INTERACTIVE, reader))
+            pace = torrent.meta.piece_length / share * 1000  # ms per piece at our share
+        else:
+            pace = 0
+
+        for piece, deadline in demand.items():
+            priority = self.PRIORITIES[priority_class]
+            if piece in urgent:
+                deadline, priority = 0, self.PRIORITIES[INTERACTIVE]
+            elif priority_class == INTERACTIVE and deadline:
+                deadline = max(deadline, int((piece - origin) * pace))
+            self._demand.setdefault((torrent, piece), {})[reader] = (now + deadline, priority)
+
+        for piece in released:
+            self._drop(reader, torrent, piece)
+
+        pieces = (pieces | demand.keys()).difference(released)
+        self._readers[reader] = (torrent, priority_class, pieces)
+        self._apply(torrent, list(demand) + list(released), now)
+
+    def release(self, reader):
+        """Drop all demand of reader, when it jumps elsewhere or closes"""
+        now = time.monotonic() * 1000
+
+        with self._lock:
+            torrent, _, pieces = self._readers.pop(reader, (None, None, set()))
+            for piece in pieces:
+                self._drop(reader, torrent, piece)
+            if pieces:
+                self._apply(torrent, pieces, now)
+
+    def reapply(self, torrent):
+        """Set the demand on torrent again, once it was added to libtorrent again"""
+        now = time.monotonic() * 1000
+
+        with self._lock:
+            pieces = [piece for t, piece in self._demand if t is torrent]
+            if pieces:
+                self._apply(torrent, pieces, now)
+
+    def forget(self, torrent):
+        """Drop all state kept for torrent, once the session forgot it"""
+        with self._lock:
+            for reader in [r for r, (t, _, _) in self._readers.items() if t is torrent]:
+                del self._readers[reader]
+            for key in [k for k in self._demand if k[0] is torrent]:
+                del self._demand[key]
+            for key in [k for k in self._applied if k[0] is torrent]:
+                del self._applied[key]
+
+    def _drop(self, reader, torrent, piece):
+        readers = self._demand.get((torrent, piece))
+        if readers is not None:
+            readers.pop(reader, None)
+            if not readers:
+                del self._demand[(torrent, piece)]
+
+    def _apply(self, torrent, pieces, now):
+        handle = torrent.handle
+        if handle is None:  # removed, `reapply` sets the demand once it is added again
+            return
+
+        for piece in pieces:
+            key = (torrent, piece)
+            readers = self._demand.get(key)
+            applied = self._applied.get(key)
+
+            if not readers:
+                if applied:
+                    del self._applied[key]
+                    handle.reset_piece_deadline(piece)
+                    handle.piece_priority(piece, torrent.default_priority)
+                continue
+
+            priority = max(p for _, p in readers.values())
+            deadline = min(d for d, p in readers.values() if p == priority)
+            if priority < self.PRIORITIES[INTERACTIVE]:
+                deadline = None  # a deadline would raise the piece to the top priority
+
+            if applied and applied[2] is handle and applied[1] == priority:
+                if deadline is None and applied[0] is None:
+                    continue
+                if deadline is not None and applied[0] is not None and applied[0] - deadline < self.TOLERANCE:
+                    continue
+
+            handle.piece_priority(piece, priority)
+            if deadline is not None:
+                handle.set_piece_deadline(piece, max(0, int(deadline - now)))
+            elif applied and applied[0] is not None:
+                handle.reset_piece_deadline(piece)
+            self._applied[key] = (deadline, priority, handle)
+
+    def _count(self, priority_class, reader):
+        return sum(1 for r, (_, c, _) in self._readers.items() if c == priority_class or r is reader)
+
+    def _download_rate(self):
+        measured, rate = self._rate
+        if time.monotonic() - measured >= self.RATE_TTL and self.session is not None:
+            rate = sum(t.handle.status().download_payload_rate for t in self.session if t.active)
+            self._rate = (time.monotonic(), rate)
+        return max(rate, self.MIN_RATE)
+
+
+def add_session_arguments(parser):
+    """Add the command line options of a `TorrentSession` to an argparse parser"""
+    parser.add_argument("--piece-cache", help="Megabytes of downloaded pieces to keep in memory (0 disables)",
+                        type=int, default=int(os.environ.get('PIECE_CACHE', 0)))
+    parser.add_argument("--cache-dir", help="Keep downloaded data in this directory across remounts",
+                        default=os.environ.get('CACHE_DIR'))
+    parser.add_argument("--cache-size", help="Megabytes of downloaded data to keep in --cache-dir (0 is unbounded)",
+                        type=int, default=int(os.environ.get('CACHE_SIZE', 0)))
+    parser.add_argument("--max-active", help="Maximum number of torrents downloading at the same time",
+                        type=int, default=int(os.environ.get('MAX_ACTIVE', MAX_ACTIVE)))
+    parser.add_argument("--idle-timeout", help="Seconds without reads before a torrent is paused, and again before it is removed",
+                        type=float, default=float(os.environ.get('IDLE_TIMEOUT', IDLE_TIMEOUT)))
+    parser.add_argument("--profile", help="libtorrent settings profile", choices=sorted(PROFILES),
+                        default=os.environ.get('PROFILE', PROFILE))
+    parser.add_argument("-p", "--port", help="Port to listen on for peers, random if not set",
+                        type=int, default=int(os.environ.get('PORT', 0)) or None)
+    parser.add_argument("--peer", help="host:port of a peer every torrent connects to, may be repeated",
+                        action="append", default=[p for p in os.environ.get('PEERS', '').split(',') if p])
+    parser.add_argument("--probe-budget", help="Megabytes of file heads and tails prefetched on open at once (0 disables)",
+                        type=int, default=int(os.environ.get('PROBE_BUDGET', PROBE_BUDGET // MiB)))
+    parser.add_argument("--read-timeout", help="Seconds a read waits for pieces before failing with ETIMEDOUT (0 waits forever)",
+                        type=float, default=float(os.environ.get('READ_TIMEOUT', READ_TIMEOUT)))
+    parser.add_argument("--stall-timeout", help="Seconds without progress on awaited pieces before announcing again (0 disables)",
+                        type=float, default=float(os.environ.get('STALL_TIMEOUT', STALL_TIMEOUT)))
+    parser.add_argument("--payload-dir", help="Directory to look for local copies of torrent payloads in, "
+                        "relative to the .torrent file unless absolute, may be repeated",
+                        action="append", default=[p for p in os.environ.get('PAYLOAD_DIRS', '').split(os.pathsep) if p])
+    parser.add_argument("--setting", help="name=value of a libtorrent setting applied over the profile, "
+                        "e.g. enable_dht=false, may be repeated",
+                        action="append", default=[s for s in os.environ.get('SETTINGS', '').split(',') if s])
+    parser.add_argument("--no-trackers", help="Do not add the default public trackers to torrents",
+                        action="store_true", default=bool(os.environ.get('NO_TRACKERS')))
+
+
+def parse_setting(text):
+    """Split a name=value libtorrent setting, with the value as a bool or int where it looks like one"""
+    name, sep, value = text.partition('=')
+    if not sep:
+        raise ValueError(f"Expected name=value: {text}")
+    if value.lower() in ('true', 'false'):
+        return name.strip(), value.lower() == 'true'
+    try:
+        return name.strip(), int(value, 0)
+    except ValueError:
+        return name.strip(), value
+
+
+def session_options(args):
+    """Return the `TorrentSession` arguments for options added by `add_session_arguments`"""
+    return dict(piece_cache_size=args.piece_cache * MiB, cache_dir=args.cache_dir, cache_size=args.cache_size * MiB,
+                max_active=args.max_active, idle_timeout=args.idle_timeout, profile=args.profile, port=args.port,
+                peers=[(host, int(port)) for host, port in (peer.rsplit(':', 1) for peer in args.peer)],
+                probe_budget=args.probe_budget * MiB, read_timeout=args.read_timeout,
+                stall_timeout=args.stall_timeout, payload_dirs=args.payload_dir,
+                settings=dict(map(parse_setting, args.setting)), trackers=() if args.no_trackers else TRACKERS)